@@ -28,6 +28,9 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'xz': ['backports.lzma'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence data loading and API endpoints.
+
+Usage::
+
+    bin/python-console -m presence_analyzer.benchmark parser 100000 1000000
+    bin/python-console -m presence_analyzer.benchmark memory 10000000
+    bin/python-console -m presence_analyzer.benchmark generate out 500 250
+    bin/python-console -m presence_analyzer.benchmark run \\
+        --users 500 --days 250 --output run.json --baseline baseline.json
+
+``run`` prints results as JSON and exits with status 1 when some of them
+regressed against the baseline. Load of the API served by Paste
+threadpool server is tested with ``bin/flask-ctl bench``.
+"""
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Command line of the benchmarks.
+"""
+import argparse
+import json
+import os
+import sys
+
+from presence_analyzer import benchmark
+from presence_analyzer.benchmark.generate import generate_csv, \
+    generate_users_xml
+from presence_analyzer.benchmark.loading import MERGE_FUNCTIONS, \
+    bench_memory, bench_parsers
+from presence_analyzer.benchmark.suite import DEFAULT_TOLERANCE, compare, \
+    run_suite
+
+
+def generate(args):
+    """
+    Writes presence.csv and users.xml of given scale to a directory.
+    """
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    rows = generate_csv(
+        os.path.join(args.directory, 'presence.csv'), args.users, args.days,
+        args.seed,
+    )
+    generate_users_xml(
+        os.path.join(args.directory, 'users.xml'), args.users, args.seed,
+    )
+    print '%d rows of %d users written to %s' % (
+        rows, args.users, args.directory,
+    )
+
+
+def run(args):
+    """
+    Runs benchmark suite, compares it with baseline.
+    """
+    result = run_suite(
+        args.users, args.days, args.seed, args.repeat, not args.no_memory,
+    )
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print output
+    failed = bool(result['errors'])
+    for name, count in sorted(result['errors'].items()):
+        print >> sys.stderr, 'ERROR %s: %d failed requests' % (name, count)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['meta']['rows'] != result['meta']['rows']:
+            print >> sys.stderr, 'Baseline is of other scale'
+        for name, base, value in compare(result, baseline, args.tolerance):
+            print >> sys.stderr, 'REGRESSION %s: %.4f -> %.4f (%+.0f%%)' % (
+                name, base, value, (value / base - 1) * 100,
+            )
+            failed = True
+    return int(failed)
+
+
+def add_scale(parser):
+    """
+    Adds data scale arguments.
+    """
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=250)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    """
+    Runs benchmark given on command line.
+    """
+    parser = argparse.ArgumentParser(
+        description=benchmark.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers()
+    parser_bench = subparsers.add_parser(
+        'parser', help='compare row parsers',
+    )
+    parser_bench.add_argument(
+        'sizes', metavar='ROWS', type=int, nargs='*',
+        default=[10 ** 5, 10 ** 6, 10 ** 7],
+    )
+    parser_bench.set_defaults(run=lambda args: bench_parsers(args.sizes))
+    memory_bench = subparsers.add_parser(
+        'memory', help='compare memory of data structures',
+    )
+    memory_bench.add_argument(
+        'sizes', metavar='ROWS', type=int, nargs='*', default=[10 ** 7],
+    )
+    memory_bench.add_argument(
+        '--kind', action='append', choices=sorted(MERGE_FUNCTIONS),
+    )
+    memory_bench.set_defaults(run=lambda args: bench_memory(
+        args.sizes, args.kind or ('dict', 'columnar'),
+    ))
+    generate_command = subparsers.add_parser(
+        'generate', help='write presence CSV and users.xml',
+    )
+    generate_command.add_argument('directory')
+    add_scale(generate_command)
+    generate_command.set_defaults(run=generate)
+    run_command = subparsers.add_parser(
+        'run', help='benchmark loading and endpoints',
+    )
+    add_scale(run_command)
+    run_command.add_argument('--repeat', type=int, default=20)
+    run_command.add_argument('--no-memory', action='store_true')
+    run_command.add_argument('--output', help='write JSON results here')
+    run_command.add_argument('--baseline', help='JSON results to compare')
+    run_command.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='allowed slowdown share, %(default)s by default',
+    )
+    run_command.set_defaults(run=run)
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded generators of presence CSV and users.xml files.
+"""
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+FIRST_USER_ID = 10
+FIRST_DAY = date(2011, 1, 3)
+WEEKEND_PRESENCE = 0.05
+NAMES = ('Adam', 'Agata', 'Bartosz', 'Ewa', 'Jan', 'Kasia', 'Marek', 'Ola')
+
+
+def format_time(seconds):
+    """
+    Formats seconds since midnight as ``HH:MM:SS``.
+    """
+    return '%02d:%02d:%02d' % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60,
+    )
+
+
+def generate_csv(path, users, days, seed=0, presence=0.8):
+    """
+    Writes presence CSV of ``users`` over ``days`` days, returns rows.
+
+    Users come on a working day with probability ``presence``, rarely on
+    weekends. Every user has own usual start time and length of stay,
+    single days vary around them. Rows are ordered by day like the
+    intranet log.
+    """
+    rand = random.Random(seed)
+    habits = [
+        (rand.randint(7 * 3600, 10 * 3600), rand.randint(6 * 3600, 9 * 3600))
+        for _ in xrange(users)
+    ]
+    rows = 0
+    with open(path, 'w') as csvfile:
+        for i in xrange(days):
+            day = FIRST_DAY + timedelta(days=i)
+            chance = presence if day.weekday() < 5 else WEEKEND_PRESENCE
+            for user, (usual_start, usual_length) in enumerate(habits):
+                if rand.random() >= chance:
+                    continue
+                start = usual_start + rand.randint(-1800, 1800)
+                end = min(start + usual_length + rand.randint(-3600, 3600),
+                          24 * 3600 - 1)
+                csvfile.write('%d,%s,%s,%s\n' % (
+                    FIRST_USER_ID + user, day.isoformat(),
+                    format_time(start), format_time(end),
+                ))
+                rows += 1
+    return rows
+
+
+def generate_csv_rows(path, rows, users=100, seed=0):
+    """
+    Writes presence CSV with given number of rows spread over users.
+    """
+    rand = random.Random(seed)
+    with open(path, 'w') as csvfile:
+        for i in xrange(rows):
+            day = FIRST_DAY + timedelta(days=i // users)
+            start = rand.randint(6 * 3600, 11 * 3600)
+            end = start + rand.randint(3600, 10 * 3600)
+            csvfile.write('%d,%s,%s,%s\n' % (
+                i % users + FIRST_USER_ID, day.isoformat(),
+                format_time(start), format_time(end),
+            ))
+
+
+def generate_users_xml(path, users, seed=0, known=0.9):
+    """
+    Writes users.xml with share ``known`` of ``users`` ids of the CSV.
+
+    The others are missing like former employees. Returns ids written.
+    """
+    rand = random.Random(seed)
+    ids = [
+        FIRST_USER_ID + user for user in xrange(users)
+        if rand.random() < known
+    ]
+    with open(path, 'w') as xml:
+        xml.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.example.com</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in ids:
+            xml.write(
+                '        <user id="%d">\n'
+                '            <avatar>/api/images/users/%d</avatar>\n'
+                '            <name>%s %s.</name>\n'
+                '        </user>\n' % (
+                    user_id, user_id, escape(rand.choice(NAMES)),
+                    chr(ord('A') + rand.randint(0, 25)),
+                )
+            )
+        xml.write('    </users>\n</intranet>\n')
+    return ids
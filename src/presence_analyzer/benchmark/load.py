@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load of API endpoints served by the Paste threadpool server.
+
+The server runs in a process of its own, so client threads do not take the
+GIL from its workers and the numbers are those of the server alone.
+"""
+import multiprocessing
+import random
+import threading
+import time
+from collections import defaultdict
+from Queue import Empty, Queue
+
+from presence_analyzer import utils
+from presence_analyzer.fetcher import FetchError, HttpFetcher
+
+LOAD_ENDPOINTS = (
+    ('users', '/api/v1/users'),
+    ('user', '/api/v1/user/%(user_id)d'),
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/%(user_id)d'),
+    ('presence_weekday', '/api/v1/presence_weekday/%(user_id)d'),
+    ('presence_start_end', '/api/v1/presence_start_end/%(user_id)d'),
+    ('team_weekday', '/api/v1/team/weekday'),
+    ('team_occupancy', '/api/v1/team/occupancy'),
+)
+PERCENTILES = (50, 95, 99)
+DEFAULT_TIMEOUT = 30
+# how often stopped server notices it
+POLL_INTERVAL = 0.5
+
+
+def request_paths(user_ids, count, seed=0, endpoints=LOAD_ENDPOINTS):
+    """
+    Returns ``count`` (endpoint name, path) pairs of random endpoints and
+    users.
+    """
+    rand = random.Random(seed)
+    requests = []
+    for _ in xrange(count):
+        name, path = rand.choice(endpoints)
+        requests.append((name, path % {'user_id': rand.choice(user_ids)}))
+    return requests
+
+
+def percentile(ordered, share):
+    """
+    Returns nearest-rank percentile of sorted list, 0 when it is empty.
+    """
+    if not ordered:
+        return 0.0
+    rank = -(-share * len(ordered) // 100)
+    return ordered[max(rank, 1) - 1]
+
+
+def drive(base_url, requests, concurrency, timeout=DEFAULT_TIMEOUT):
+    """
+    Sends requests from ``concurrency`` threads over keep-alive
+    connections.
+
+    Returns (latencies by endpoint name, errors by endpoint name, seconds
+    of the whole run). Statuses other than 200 and 304 and connection
+    errors are errors, their latencies are not counted.
+    """
+    queue = Queue()
+    for request in requests:
+        queue.put(request)
+    client = HttpFetcher(timeout, concurrency)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def work():
+        """
+        Sends queued requests until there are none left.
+        """
+        while True:
+            try:
+                name, path = queue.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                client.fetch(base_url + path)
+            except FetchError:
+                with lock:
+                    errors[name] += 1
+                continue
+            seconds = time.time() - start
+            with lock:
+                latencies[name].append(seconds)
+
+    threads = [threading.Thread(target=work) for _ in xrange(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    client.close()
+    return dict(latencies), dict(errors), seconds
+
+
+def summarize(latencies, errors, seconds):
+    """
+    Returns requests, errors, requests per second and latency percentiles
+    of all requests and of every endpoint.
+    """
+    def stats(values, failed):
+        ordered = sorted(values)
+        result = {'requests': len(ordered) + failed, 'errors': failed}
+        for share in PERCENTILES:
+            result['p%d' % share] = percentile(ordered, share)
+        return result
+
+    summary = stats(
+        [value for values in latencies.values() for value in values],
+        sum(errors.values()),
+    )
+    summary['seconds'] = seconds
+    summary['rps'] = summary['requests'] / seconds if seconds else 0.0
+    summary['endpoints'] = dict(
+        (name, stats(latencies.get(name, ()), errors.get(name, 0)))
+        for name in set(latencies) | set(errors)
+    )
+    return summary
+
+
+def start_server(app, host='127.0.0.1', port=0, workers=10,
+                 spawn_if_under=5, max_requests=0):
+    """
+    Serves app in a background thread with Paste threadpool server
+    configured like ``[server:main]`` of deploy.ini. Returns the server.
+    """
+    from paste import httpserver
+    server = httpserver.serve(
+        app, host, port, start_loop=False, use_threadpool=True,
+        threadpool_workers=workers, threadpool_options={
+            'spawn_if_under': spawn_if_under, 'max_requests': max_requests,
+        },
+    )
+    server.timeout = POLL_INTERVAL
+    server.loop = threading.Thread(target=server.serve_forever)
+    server.loop.daemon = True
+    server.loop.start()
+    return server
+
+
+def stop_server(server):
+    """
+    Stops server started by ``start_server``.
+    """
+    server.running = False
+    server.loop.join()
+    server.server_close()
+
+
+def serve(app, connection, threadpool):
+    """
+    Serves app until anything is received from ``connection``, its
+    address is sent there first. Target of the server process.
+    """
+    server = start_server(app, **threadpool)
+    connection.send(server.server_address[:2])
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    stop_server(server)
+
+
+def start_server_process(app, **threadpool):
+    """
+    Starts ``start_server`` in a forked process.
+
+    Returns (process, connection, (host, port)), pass the first two to
+    ``stop_server_process``. Raises RuntimeError when the server does not
+    start, its error is printed by the process.
+    """
+    connection, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=serve, args=(app, child, threadpool),
+    )
+    process.daemon = True
+    process.start()
+    child.close()
+    try:
+        address = connection.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('Load test server did not start')
+    return process, connection, address
+
+
+def stop_server_process(process, connection):
+    """
+    Stops server process started by ``start_server_process``.
+    """
+    connection.send(None)
+    connection.close()
+    process.join()
+
+
+def run_load(app, requests=1000, concurrency=10, seed=0,
+             timeout=DEFAULT_TIMEOUT, **threadpool):
+    """
+    Loads dataset, serves app and drives random requests against it.
+
+    Dataset is loaded before the server process is forked, so it serves
+    the same data. ``threadpool`` options are passed to ``start_server``.
+    Returns ``summarize`` result with ``threadpool`` and ``concurrency``
+    added.
+    """
+    user_ids = list(utils.get_weekday_stats().users)
+    process, connection, (host, port) = start_server_process(
+        app, **threadpool
+    )
+    try:
+        latencies, errors, seconds = drive(
+            'http://%s:%d' % (host, port),
+            request_paths(user_ids, requests, seed), concurrency, timeout,
+        )
+    finally:
+        stop_server_process(process, connection)
+    summary = summarize(latencies, errors, seconds)
+    summary['threadpool'] = threadpool
+    summary['concurrency'] = concurrency
+    return summary
+
+
+def format_report(summary):
+    """
+    Formats ``run_load`` result as a table with milliseconds.
+    """
+    lines = [
+        ', '.join(
+            '%s %s' % (name, value)
+            for name, value in sorted(summary['threadpool'].items())
+        ) + ', concurrency %d' % summary['concurrency'],
+        '%d requests in %.2fs, %.1f requests/s, %d errors' % (
+            summary['requests'], summary['seconds'], summary['rps'],
+            summary['errors'],
+        ),
+        '',
+        '%-20s %8s %7s' % ('endpoint', 'requests', 'errors') + ''.join(
+            '%9s' % ('p%d ms' % share) for share in PERCENTILES
+        ),
+    ]
+    rows = sorted(summary['endpoints'].items()) + [('all', summary)]
+    for name, stats in rows:
+        lines.append('%-20s %8d %7d' % (
+            name, stats['requests'], stats['errors'],
+        ) + ''.join(
+            '%9.1f' % (stats['p%d' % share] * 1000) for share in PERCENTILES
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of CSV parsers and memory of loaded data structures.
+"""
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from presence_analyzer.benchmark.generate import generate_csv_rows
+from presence_analyzer.dataset import merge_dataset, stream_dataset
+from presence_analyzer.loader import merge_rows, parse_row, \
+    parse_row_strptime, parse_rows, read_data
+from presence_analyzer.store import merge_store
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', '..', 'runtime', 'data',
+    'sample_data.csv',
+)
+
+
+def fold_rows(data, rows):  # pylint: disable=unused-argument
+    """
+    Folds rows into weekday summaries, keeps only their users.
+    """
+    return stream_dataset(rows).weekday_stats.users
+
+
+MERGE_FUNCTIONS = {
+    'dict': merge_rows, 'columnar': merge_store, 'streaming': fold_rows,
+    'dataset': merge_dataset,
+}
+
+
+def time_parser(path, parse):
+    """
+    Returns seconds spent parsing whole CSV file with given row parser.
+    """
+    def run():
+        with open(path) as csvfile:
+            for _ in parse_rows(csvfile, parse=parse):
+                pass
+    return timeit.timeit(run, number=1)
+
+
+def bench_parsers(sizes):
+    """
+    Compares fixed-format row parser with ``strptime`` one.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for rows in sizes:
+            path = os.path.join(tmpdir, 'presence_%d.csv' % rows)
+            generate_csv_rows(path, rows)
+            strptime = time_parser(path, parse_row_strptime)
+            fast = time_parser(path, parse_row)
+            print '%10d rows  strptime %8.2fs  fast %8.2fs  x%.1f' % (
+                rows, strptime, fast, strptime / fast,
+            )
+            os.remove(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def resident_memory():
+    """
+    Returns current resident memory of this process in KB (Linux only).
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def measure_memory(path, kind):
+    """
+    Prints peak and retained RSS growth in KB after loading CSV.
+    """
+    before = resident_memory()
+    data = read_data(path, MERGE_FUNCTIONS[kind])
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print peak - before, resident_memory() - before, data is not None
+
+
+def loaded_memory(path, kind):
+    """
+    Returns (peak, retained) RSS growth in KB of a fresh process loading
+    given file.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'from presence_analyzer.benchmark.loading import measure_memory; '
+        'measure_memory(%r, %r)' % (path, kind),
+    ], env=env)
+    peak, retained = output.split()[:2]
+    return int(peak), int(retained)
+
+
+def bench_memory(sizes, kinds=('dict', 'columnar')):
+    """
+    Compares memory of dict, columnar and streaming loading.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = [('sample', SAMPLE_DATA_CSV)]
+        for rows in sizes:
+            path = os.path.join(tmpdir, 'presence_%d.csv' % rows)
+            generate_csv_rows(path, rows)
+            paths.append((rows, path))
+        for name, path in paths:
+            for kind in kinds:
+                peak, retained = loaded_memory(path, kind)
+                print '%10s rows  %-9s  peak %8.1f MB  retained %8.1f MB' % (
+                    name, kind, peak / 1024.0, retained / 1024.0,
+                )
+    finally:
+        shutil.rmtree(tmpdir)
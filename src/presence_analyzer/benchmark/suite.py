@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of loading and API endpoints on generated data.
+
+Results are flat dict of timings in seconds and memory in MB, lower is
+better for all of them, so runs can be compared key by key.
+"""
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from presence_analyzer.benchmark.generate import FIRST_DAY, FIRST_USER_ID, \
+    generate_csv, generate_users_xml
+from presence_analyzer.benchmark.loading import loaded_memory
+from presence_analyzer.dataset import merge_dataset
+from presence_analyzer.loader import CsvIngester
+from presence_analyzer.main import app
+from presence_analyzer.snapshot import DatasetSnapshot
+from presence_analyzer import utils
+
+ENDPOINTS = (
+    ('users', '/api/v1/users'),
+    ('user', '/api/v1/user/%(user_id)d'),
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/%(user_id)d'),
+    ('presence_weekday', '/api/v1/presence_weekday/%(user_id)d'),
+    ('presence_start_end', '/api/v1/presence_start_end/%(user_id)d'),
+    ('presence_weekday_window',
+     '/api/v1/presence_weekday/%(user_id)d?from=%(from)s&to=%(to)s'),
+    ('stats_all', '/api/v1/stats?users=all&metrics=mean,total'),
+    ('team_weekday', '/api/v1/team/weekday'),
+    ('team_headcount', '/api/v1/team/headcount'),
+    ('team_occupancy', '/api/v1/team/occupancy'),
+)
+CONFIG_KEYS = ('DATA_CSV', 'USERS_XML', 'DATA_STORE', 'DATA_SNAPSHOT')
+DEFAULT_TOLERANCE = 0.25
+# differences below this many seconds are noise, never regressions
+MIN_DELTA = 0.001
+LOAD_REPEAT = 3
+
+
+def median(values):
+    """
+    Returns median of non-empty list.
+    """
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def elapsed(function, *args):
+    """
+    Returns (seconds spent in call, result).
+    """
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def time_loading(csv_path, snapshot_path, repeat=LOAD_REPEAT):
+    """
+    Returns best seconds of cold load, parsing the whole CSV, and warm
+    load from a snapshot written beforehand.
+    """
+    cold = min(
+        elapsed(CsvIngester(csv_path, merge_dataset).update)[0]
+        for _ in xrange(repeat)
+    )
+    snapshot = DatasetSnapshot(snapshot_path)
+    CsvIngester(csv_path, merge_dataset, snapshot).update()
+    warm = min(
+        elapsed(CsvIngester(csv_path, merge_dataset, snapshot).update)[0]
+        for _ in xrange(repeat)
+    )
+    return cold, warm
+
+
+def time_endpoints(params, repeat):
+    """
+    Returns first and median warm request seconds and errors by endpoint.
+
+    Every endpoint is requested first with empty caches.
+    """
+    client = app.test_client()
+
+    def get(url):
+        """
+        Requests URL, reads streamed body too.
+        """
+        response = client.get(url)
+        response.get_data()
+        return response
+
+    results = {}
+    errors = {}
+    for name, url in ENDPOINTS:
+        url = url % params
+        utils.CACHE.clear()
+        utils.load_dataset()
+        first, response = elapsed(get, url)
+        timings = []
+        failed = int(response.status_code != 200)
+        for _ in xrange(repeat):
+            seconds, response = elapsed(get, url)
+            timings.append(seconds)
+            failed += response.status_code != 200
+        results['endpoint.%s.first' % name] = first
+        results['endpoint.%s.warm' % name] = median(timings)
+        if failed:
+            errors[name] = failed
+    return results, errors
+
+
+def run_suite(users=100, days=250, seed=0, repeat=20, memory=True):
+    """
+    Generates data of given scale and benchmarks it.
+
+    Returns dict with ``meta`` describing the run, ``results`` and
+    ``errors``, number of failed requests by endpoint.
+    """
+    tmpdir = tempfile.mkdtemp()
+    saved = dict(
+        (key, app.config[key]) for key in CONFIG_KEYS if key in app.config
+    )
+    try:
+        csv_path = os.path.join(tmpdir, 'presence.csv')
+        xml_path = os.path.join(tmpdir, 'users.xml')
+        rows = generate_csv(csv_path, users, days, seed)
+        generate_users_xml(xml_path, users, seed)
+        results = {}
+        results['load.cold'], results['load.warm'] = time_loading(
+            csv_path, os.path.join(tmpdir, 'presence.snapshot'),
+        )
+        app.config.update({
+            'DATA_CSV': csv_path, 'USERS_XML': xml_path,
+            'DATA_STORE': None, 'DATA_SNAPSHOT': False,
+        })
+        utils.load_dataset.invalidate()
+        endpoints, errors = time_endpoints({
+            'user_id': FIRST_USER_ID,
+            'from': (FIRST_DAY + timedelta(days=days // 4)).isoformat(),
+            'to': (FIRST_DAY + timedelta(days=days // 2)).isoformat(),
+        }, repeat)
+        results.update(endpoints)
+        if memory:
+            peak, _ = loaded_memory(csv_path, 'dataset')
+            results['memory.peak_mb'] = peak / 1024.0
+    finally:
+        for key in CONFIG_KEYS:
+            app.config.pop(key, None)
+        app.config.update(saved)
+        utils.load_dataset.invalidate()
+        utils.CACHE.clear()
+        shutil.rmtree(tmpdir)
+    return {
+        'meta': {
+            'users': users, 'days': days, 'seed': seed, 'rows': rows,
+            'repeat': repeat, 'python': platform.python_version(),
+            'time': int(time.time()),
+        },
+        'results': results,
+        'errors': errors,
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE,
+            min_delta=MIN_DELTA):
+    """
+    Returns regressions of ``current`` results against ``baseline`` ones.
+
+    A result regresses when it is more than ``tolerance`` share and more
+    than ``min_delta`` above the baseline. Regressions are sorted list of
+    (name, baseline, current) tuples.
+    """
+    regressions = []
+    for name, value in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if value > base * (1 + tolerance) and value - base > min_delta:
+            regressions.append((name, base, value))
+    return regressions
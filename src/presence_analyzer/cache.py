@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache with LRU eviction and per-entry expiration.
+"""
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, RLock
+
+DEFAULT_MAX_SIZE = 1024
+
+MISSING = object()
+
+
+def make_key(function, args, kwargs):
+    """
+    Builds cache key of a function call from its name and arguments.
+    """
+    return (
+        function.__module__, function.__name__, args,
+        tuple(sorted(kwargs.items())),
+    )
+
+
+class Cache(object):
+    """
+    Cache of at most ``max_size`` entries.
+
+    Least recently used entries are evicted first, entries stored with
+    ``ttl`` expire after that many seconds. Hits, misses and evictions are
+    counted.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Returns cached value, ``default`` for missing or expired keys.
+        """
+        value, expired = self.get_entry(key)
+        if value is MISSING or expired:
+            return default
+        return value
+
+    def get_entry(self, key):
+        """
+        Returns (value, expired) pair, value is ``MISSING`` for missing keys.
+
+        Expired entries are kept until evicted, so they can be served while
+        a new value is computed.
+        """
+        with self.lock:
+            expires, value = self.entries.pop(key, (None, MISSING))
+            if value is MISSING:
+                self.misses += 1
+                return value, False
+            self.entries[key] = (expires, value)
+            expired = expires is not None and expires <= time.time()
+            if expired:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value, expired
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value, evicting least recently used entries when full.
+        """
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Removes given key.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns counters and current size.
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class KeyLocks(object):
+    """
+    Locks created on demand for every key and dropped once released.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.locks = {}
+
+    @contextmanager
+    def __call__(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data with summaries materialized at load time.
+"""
+import time
+from threading import Lock
+
+from presence_analyzer.main import app
+from presence_analyzer.metrics import timed
+from presence_analyzer.stats import TeamStats, WeekdayAccumulator, \
+    WeekdayIndex, WeekdayStats, DEFAULT_PERCENTILES
+from presence_analyzer.store import PresenceStore, user_columns
+
+_last_version = [0]  # pylint: disable=invalid-name
+_version_lock = Lock()  # pylint: disable=invalid-name
+
+
+def next_version():
+    """
+    Returns current time in milliseconds, always greater than the last one.
+    """
+    with _version_lock:
+        _last_version[0] = max(_last_version[0] + 1, int(time.time() * 1000))
+        return _last_version[0]
+
+
+class Dataset(object):
+    """
+    Columnar presence store together with summaries computed from it.
+
+    Summaries are computed once, when the dataset is built, so views only
+    look values up. ``version`` is the build time in milliseconds and
+    grows with every dataset built in this process. Summaries and version
+    of a dataset built elsewhere (a snapshot or a shared segment) or
+    updated from the previous one can be given directly. Datasets built
+    by ``stream_dataset`` have only summaries and ``store`` is None.
+
+    ``team_stats`` rolls summaries of all users up. ``weekday_index``
+    for date range queries is built on first use.
+    """
+
+    def __init__(self, store, percentiles=DEFAULT_PERCENTILES,
+                 weekday_stats=None, version=None, team_stats=None):
+        self.version = version or next_version()
+        self.store = store
+        self.weekday_stats = weekday_stats or \
+            WeekdayStats.from_store(store, percentiles)
+        # summaries without percentile columns (streaming) still have
+        # user means, their percentiles are rolled up as configured
+        self.team_stats = team_stats or TeamStats.from_store(
+            store, self.weekday_stats,
+            self.weekday_stats.percentiles or percentiles,
+        )
+        self._weekday_index = None
+        self._index_lock = Lock()
+
+    @property
+    def weekday_index(self):
+        """
+        Returns ``WeekdayIndex`` of the store, None without store.
+        """
+        if self._weekday_index is None and self.store is not None:
+            with self._index_lock:
+                if self._weekday_index is None:
+                    self._weekday_index = WeekdayIndex.from_store(self.store)
+        return self._weekday_index
+
+
+def merge_dataset(dataset, rows):
+    """
+    Merges parsed rows into given dataset, ``CsvIngester`` merge function.
+
+    Summaries are updated only for users with new rows.
+    """
+    columns = user_columns(rows)
+    if dataset is None:
+        return make_dataset(PresenceStore.from_user_columns(columns))
+    if not columns:
+        return dataset
+    return update_dataset(dataset, dataset.store.merge_columns(columns),
+                          columns)
+
+
+def dataset_from_user_columns(columns):
+    """
+    Builds dataset from per-user columns, ``CsvIngester`` parallel reads.
+    """
+    return make_dataset(PresenceStore.from_user_columns(columns))
+
+
+@timed('summaries')
+def stream_dataset(rows):
+    """
+    Folds rows into weekday summaries without keeping the rows.
+    """
+    accumulator = WeekdayAccumulator()
+    for row in rows:
+        accumulator.add(*row)
+    return Dataset(
+        None, app.config.get('WEEKDAY_PERCENTILES', DEFAULT_PERCENTILES),
+        weekday_stats=accumulator.to_stats(),
+    )
+
+
+@timed('summaries')
+def update_dataset(dataset, store, touched):
+    """
+    Builds dataset of a store which differs from the one of given dataset
+    only in rows of ``touched`` user ids.
+    """
+    weekday_stats = dataset.weekday_stats.merge(store, touched)
+    team_stats = dataset.team_stats.merge(
+        dataset.store, store, touched, weekday_stats,
+    )
+    return Dataset(store, weekday_stats=weekday_stats, team_stats=team_stats)
+
+
+@timed('summaries')
+def make_dataset(store):
+    """
+    Builds dataset of given store with configured percentiles.
+    """
+    return Dataset(
+        store, app.config.get('WEEKDAY_PERCENTILES', DEFAULT_PERCENTILES),
+    )
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP client with a pool of keep-alive connections.
+"""
+import httplib
+import logging
+import socket
+import urlparse
+from threading import BoundedSemaphore, Lock
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_TIMEOUT = 5
+DEFAULT_MAX_CONNECTIONS = 4
+
+
+class FetchError(Exception):
+    """
+    Raised when a resource cannot be fetched.
+    """
+
+
+class HttpFetcher(object):
+    """
+    Fetches URLs with GET requests over pooled keep-alive connections.
+
+    At most ``max_connections`` requests run at once, further ones wait
+    for a free slot. Connecting and every read time out after ``timeout``
+    seconds. Connections left open by servers are kept idle per host and
+    reused by later requests.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.timeout = timeout
+        self.slots = BoundedSemaphore(max_connections)
+        self.idle = {}
+        self.lock = Lock()
+
+    def connect(self, scheme, netloc):
+        """
+        Returns (connection, reused), idle connection if there is one.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            factory = httplib.HTTPSConnection
+        else:
+            factory = httplib.HTTPConnection
+        return factory(netloc, timeout=self.timeout), False
+
+    def release(self, scheme, netloc, connection):
+        """
+        Keeps connection for reuse.
+        """
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def fetch(self, url, headers=None):
+        """
+        Returns (status, headers, body) of GET request of given URL.
+
+        Response headers are keyed by lower case names. Raises
+        ``FetchError`` on connection errors, timeouts and statuses other
+        than 200 and 304.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self.slots:
+            while True:
+                connection, reused = self.connect(parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers=headers or {})
+                    response = connection.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error) as error:
+                    connection.close()
+                    if reused:
+                        # server has closed the idle connection meanwhile
+                        log.debug('Reconnecting to %s', parts.netloc)
+                        continue
+                    raise FetchError('%s: %s' % (url, error or 'timed out'))
+                break
+            # back in the pool before the slot is free to next request
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(parts.scheme, parts.netloc, connection)
+        if response.status not in (200, 304):
+            raise FetchError('%s: HTTP %d' % (url, response.status))
+        return response.status, dict(response.getheaders()), body
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data CSV ingestion.
+
+CSV files with ``.gz``, ``.bz2`` or ``.xz`` extension are decompressed
+while they are read, ``.xz`` needs ``backports.lzma`` on Python 2.
+"""
+import bz2
+import csv
+import hashlib
+import logging
+import multiprocessing
+import os
+import time as clock
+import zlib
+from cStringIO import StringIO
+from datetime import date, datetime, time
+from functools import partial
+from threading import Lock
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  # pylint: disable=invalid-name
+
+from presence_analyzer.metrics import timed
+from presence_analyzer.store import user_columns
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# bytes before the consumed offset compared to detect in-place rewrites
+TAIL_SIZE = 64
+BLOCK_SIZE = 1 << 20
+# chunks per process of parallel reads, to even out slower chunks
+CHUNKS_PER_WORKER = 4
+# seconds between snapshots written after reading appended rows
+SNAPSHOT_INTERVAL = 300
+
+
+def parse_row_strptime(row):
+    """
+    Parses CSV row fields with ``datetime.strptime``.
+    """
+    return (
+        int(row[0]),
+        datetime.strptime(row[1], '%Y-%m-%d').date(),
+        datetime.strptime(row[2], '%H:%M:%S').time(),
+        datetime.strptime(row[3], '%H:%M:%S').time(),
+    )
+
+
+def parse_date(value):
+    """
+    Parses ``YYYY-MM-DD`` date, returns None for other layouts.
+    """
+    if len(value) == 10 and value[4] == value[7] == '-' \
+            and (value[:4] + value[5:7] + value[8:]).isdigit():
+        return date(int(value[:4]), int(value[5:7]), int(value[8:]))
+
+
+def parse_time(value):
+    """
+    Parses ``HH:MM:SS`` time, returns None for other layouts.
+    """
+    if len(value) == 8 and value[2] == value[5] == ':' \
+            and (value[:2] + value[3:5] + value[6:]).isdigit():
+        return time(int(value[:2]), int(value[3:5]), int(value[6:]))
+
+
+# parsed dates and times by their text, there are at most a few thousand
+# days and 86400 seconds in a log so both stay small
+_dates = {}  # pylint: disable=invalid-name
+_times = {}  # pylint: disable=invalid-name
+
+
+def parse_row(row):
+    """
+    Parses CSV row fields of ``user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS`` layout.
+
+    Digits are sliced directly and repeated values are looked up. Fields
+    not matching the fixed layout go through ``parse_row_strptime`` so
+    results and errors stay the same.
+    """
+    day = _dates.get(row[1]) or parse_date(row[1])
+    start = _times.get(row[2]) or parse_time(row[2])
+    end = _times.get(row[3]) or parse_time(row[3])
+    if day is None or start is None or end is None:
+        return parse_row_strptime(row)
+    _dates[row[1]] = day
+    _times[row[2]] = start
+    _times[row[3]] = end
+    return int(row[0]), day, start, end
+
+
+def split_rows(lines):
+    """
+    Splits CSV lines into fields, ``csv`` module is used only for quoting.
+    """
+    for line in lines:
+        if '"' in line:
+            for row in csv.reader([line], delimiter=','):
+                yield row
+        else:
+            yield line.rstrip('\r\n').split(',')
+
+
+def parse_rows(lines, first_line=0, parse=parse_row):
+    """
+    Parses presence CSV lines into (user_id, date, start, end) tuples.
+
+    Header, footer and malformed lines are skipped.
+    """
+    for i, row in enumerate(split_rows(lines), first_line):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            yield parse(row)
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+
+
+def merge_rows(data, rows):
+    """
+    Merges parsed rows into copy of given presence data.
+
+    Only users touched by new rows get their dict copied, so structures
+    returned earlier are never modified.
+    """
+    result = dict(data or {})
+    copied = set()
+    for user_id, day, start, end in rows:
+        if user_id not in copied:
+            result[user_id] = dict(result.get(user_id, {}))
+            copied.add(user_id)
+        result[user_id][day] = {'start': start, 'end': end}
+    return result
+
+
+def gzip_decompressor():
+    """
+    Returns decompressor of a gzip member.
+    """
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def xz_decompressor():
+    """
+    Returns decompressor of an xz stream.
+    """
+    if lzma is None:
+        raise IOError('Reading .xz files needs backports.lzma installed')
+    return lzma.LZMADecompressor()
+
+
+DECOMPRESSORS = {
+    '.gz': gzip_decompressor, '.bz2': bz2.BZ2Decompressor,
+    '.xz': xz_decompressor,
+}
+
+
+def get_decompressor(path):
+    """
+    Returns decompressor factory for extension of compressed file, None
+    for other files.
+    """
+    return DECOMPRESSORS.get(os.path.splitext(path)[1].lower())
+
+
+def decompress(datafile, decompressor):
+    """
+    Yields decompressed blocks of file read from the current position.
+
+    Concatenated compressed streams, like appended gzip members, are all
+    read.
+    """
+    state = decompressor()
+    for block in iter(partial(datafile.read, BLOCK_SIZE), ''):
+        while block:
+            try:
+                yield state.decompress(block)
+            except EOFError:
+                # previous stream ended right at the end of the last block
+                state = decompressor()
+                continue
+            block = state.unused_data
+            if block:
+                state = decompressor()
+
+
+def split_lines(blocks):
+    """
+    Yields lines of text blocks, with line ends kept.
+    """
+    rest = ''
+    for block in blocks:
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def data_lines(datafile, path):
+    """
+    Returns lines of open presence file, decompressed when ``path`` has
+    extension of compressed file.
+    """
+    decompressor = get_decompressor(path)
+    if decompressor is None:
+        return datafile
+    return split_lines(decompress(datafile, decompressor))
+
+
+def read_data(path, merge=merge_rows):
+    """
+    Reads whole presence CSV file and groups it by user_id.
+    """
+    with open(path, 'rb') as csvfile:
+        return merge(None, parse_rows(data_lines(csvfile, path)))
+
+
+def iter_rows(path):
+    """
+    Yields rows of presence CSV file parsed line by line.
+    """
+    with open(path, 'rb') as csvfile:
+        for row in parse_rows(data_lines(csvfile, path)):
+            yield row
+
+
+def file_hash(csvfile, size):
+    """
+    Returns SHA-1 digest of first ``size`` bytes of given file.
+    """
+    digest = hashlib.sha1()
+    csvfile.seek(0)
+    while size > 0:
+        block = csvfile.read(min(BLOCK_SIZE, size))
+        if not block:
+            break
+        digest.update(block)
+        size -= len(block)
+    return digest.digest()
+
+
+def last_line_end(csvfile, size):
+    """
+    Returns offset just after the last newline in first ``size`` bytes.
+    """
+    end = size
+    while end > 0:
+        start = max(end - BLOCK_SIZE, 0)
+        csvfile.seek(start)
+        position = csvfile.read(end - start).rfind('\n')
+        if position >= 0:
+            return start + position + 1
+        end = start
+    return 0
+
+
+def chunk_ranges(path, size, count):
+    """
+    Splits first ``size`` bytes of file into ``count`` byte ranges which
+    start and end on line boundaries.
+    """
+    boundaries = [0]
+    with open(path, 'rb') as csvfile:
+        for i in xrange(1, count):
+            csvfile.seek(size * i // count)
+            csvfile.readline()
+            boundaries.append(min(max(csvfile.tell(), boundaries[-1]), size))
+    boundaries.append(size)
+    return [
+        (start, stop) for start, stop in zip(boundaries, boundaries[1:])
+        if start < stop
+    ]
+
+
+def parse_chunk(args):
+    """
+    Parses byte range of CSV file into per-user columns.
+
+    Returns (columns, number of newlines). Line numbers logged for
+    malformed rows are counted from the start of the chunk.
+    """
+    path, start, stop = args
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start)
+        chunk = csvfile.read(stop - start)
+    return user_columns(parse_rows(StringIO(chunk))), chunk.count('\n')
+
+
+def read_user_columns_parallel(path, size, workers):
+    """
+    Parses first ``size`` bytes of CSV file in a pool of ``workers``
+    processes.
+
+    Returns (columns, lines): dict of (days, starts, ends) arrays by user
+    id with rows of every user in file order, as if parsed serially, and
+    number of complete lines.
+    """
+    ranges = chunk_ranges(path, size, workers * CHUNKS_PER_WORKER)
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(
+            parse_chunk, [(path, start, stop) for start, stop in ranges],
+        )
+    finally:
+        pool.close()
+        pool.join()
+    columns = {}
+    lines = 0
+    for chunk_columns, chunk_lines in results:
+        lines += chunk_lines
+        for user_id in sorted(chunk_columns):
+            if user_id in columns:
+                for column, values in zip(columns[user_id],
+                                          chunk_columns[user_id]):
+                    column.extend(values)
+            else:
+                columns[user_id] = chunk_columns[user_id]
+    return columns, lines
+
+
+class CsvIngester(object):
+    """
+    Append-aware reader of a growing presence CSV file.
+
+    Remembers the file identity and the offset of the last complete line,
+    so an update parses only appended rows. Truncated, rotated or rewritten
+    files are read again from the start.
+
+    ``merge(data, rows)`` folds parsed rows into data read so far, which is
+    None before the first read. Optional ``snapshot`` (see
+    ``presence_analyzer.snapshot``) of the file or of its beginning is
+    loaded instead of parsing the file from the start, rows appended
+    since are parsed after it. It is written after every full read and
+    at most every ``SNAPSHOT_INTERVAL`` seconds after reading appended
+    rows.
+
+    With ``workers`` > 1 and ``from_columns`` given, full reads are split
+    between processes which return per-user columns (see
+    ``read_user_columns_parallel``), ``from_columns`` turns them into data.
+
+    Compressed files cannot be read from an offset, they are read again
+    whole whenever they change.
+    """
+
+    def __init__(self, path, merge=merge_rows, snapshot=None, workers=1,
+                 from_columns=None):
+        self.path = path
+        self.merge = merge
+        self.snapshot = snapshot
+        self.workers = workers
+        self.from_columns = from_columns
+        self.decompressor = get_decompressor(path)
+        self.saved = 0
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything read so far.
+        """
+        self.data = self.merge(None, ())
+        self.identity = None
+        self.offset = 0
+        self.lines = 0
+        self.tail = ''
+
+    def is_appended(self, csvfile, stat):
+        """
+        Checks if file is the one read before with data only appended.
+        """
+        if self.identity is None:
+            return True
+        device, inode, size, mtime = self.identity
+        if (stat.st_dev, stat.st_ino) != (device, inode):
+            return False
+        if stat.st_size < size:
+            return False
+        if stat.st_size == size and stat.st_mtime != mtime:
+            return False
+        csvfile.seek(self.offset - len(self.tail))
+        return csvfile.read(len(self.tail)) == self.tail
+
+    @timed('csv_ingest')
+    def update(self):
+        """
+        Reads rows appended since the last update, returns presence data.
+        """
+        with self.lock:
+            with open(self.path, 'rb') as csvfile:
+                stat = os.fstat(csvfile.fileno())
+                identity = (
+                    stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+                )
+                if self.decompressor is not None \
+                        and identity != self.identity:
+                    self.reset()
+                if not self.is_appended(csvfile, stat):
+                    log.info('%s was truncated or replaced, reloading',
+                             self.path)
+                    self.reset()
+                if identity == self.identity:
+                    return self.data
+                if not self.offset and self.snapshot is not None:
+                    self.restore(csvfile, stat)
+                full = not self.offset
+                offset = self.offset
+                digest = None
+                if full and self.decompressor is not None:
+                    self.read_compressed(csvfile, stat)
+                elif full and self.workers > 1 \
+                        and self.from_columns is not None:
+                    self.read_parallel(csvfile, stat)
+                else:
+                    csvfile.seek(self.offset)
+                    chunk = csvfile.read(stat.st_size - self.offset)
+                    self.read_chunk(chunk)
+                    if full:
+                        digest = hashlib.sha1(chunk).digest()
+                save = self.snapshot is not None and (full or (
+                    self.offset != offset and
+                    clock.time() - self.saved >= SNAPSHOT_INTERVAL
+                ))
+                if save and digest is None:
+                    digest = file_hash(csvfile, stat.st_size)
+            self.identity = identity
+            if save:
+                self.saved = clock.time()
+                try:
+                    self.snapshot.save(
+                        stat, digest, self.data, self.offset, self.lines,
+                    )
+                except (IOError, OSError):
+                    log.warning('Cannot write snapshot of %s', self.path,
+                                exc_info=True)
+            return self.data
+
+    def read_chunk(self, chunk):
+        """
+        Merges rows of bytes read from the current offset.
+        """
+        if not chunk:
+            return
+        # last line without newline may still be written, it is parsed
+        # now and read again with the next update
+        complete = chunk.rfind('\n') + 1
+        self.data = self.merge(
+            self.data, parse_rows(StringIO(chunk), self.lines),
+        )
+        self.lines += chunk.count('\n', 0, complete)
+        self.offset += complete
+        self.tail = (self.tail + chunk[:complete])[-TAIL_SIZE:]
+
+    def read_compressed(self, csvfile, stat):
+        """
+        Reads whole compressed file, its end is the offset read to.
+        """
+        csvfile.seek(0)
+        self.data = self.merge(
+            self.data, parse_rows(data_lines(csvfile, self.path)),
+        )
+        self.offset = stat.st_size
+        start = max(self.offset - TAIL_SIZE, 0)
+        csvfile.seek(start)
+        self.tail = csvfile.read(self.offset - start)
+
+    def read_parallel(self, csvfile, stat):
+        """
+        Reads whole file in chunks parsed by a pool of processes.
+        """
+        columns, self.lines = read_user_columns_parallel(
+            self.path, stat.st_size, self.workers,
+        )
+        self.data = self.from_columns(columns)
+        self.offset = last_line_end(csvfile, stat.st_size)
+        start = max(self.offset - TAIL_SIZE, 0)
+        csvfile.seek(start)
+        self.tail = csvfile.read(self.offset - start)
+
+    def restore(self, csvfile, stat):
+        """
+        Takes data and position from snapshot matching the file.
+        """
+        restored = self.snapshot.load(csvfile, stat)
+        if restored is None:
+            return
+        dataset, offset, lines = restored
+        if self.decompressor is not None and offset != stat.st_size:
+            # compressed file cannot be continued from an offset
+            return
+        self.data, self.offset, self.lines = dataset, offset, lines
+        start = max(self.offset - TAIL_SIZE, 0)
+        csvfile.seek(start)
+        self.tail = csvfile.read(self.offset - start)
+        log.info('Loaded %s from snapshot', self.path)
+
+
+_ingesters = {}  # pylint: disable=invalid-name
+_ingesters_lock = Lock()  # pylint: disable=invalid-name
+
+
+def get_ingester(path, merge=merge_rows, **kwargs):
+    """
+    Returns shared ingester for given CSV path and merge function.
+
+    Other ``CsvIngester`` arguments are used only by the ingester created
+    by the first call.
+    """
+    with _ingesters_lock:
+        if (path, merge) not in _ingesters:
+            _ingesters[path, merge] = CsvIngester(path, merge, **kwargs)
+        return _ingesters[path, merge]
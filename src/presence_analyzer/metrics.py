@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms and counters exposed in Prometheus text format.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def format_labels(labels):
+    """
+    Formats sorted (name, value) pairs as Prometheus labels.
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+
+
+def format_value(value):
+    """
+    Formats sample value, integers without fraction.
+    """
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class Histogram(object):
+    """
+    Counts of observed values per bucket, with their sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        """
+        Adds value to the first bucket with upper bound not below it.
+        """
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.total += value
+
+    def samples(self):
+        """
+        Returns (cumulative counts by upper bound, sum, count).
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        cumulative = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            count += bucket_count
+            cumulative.append((bound, count))
+        return cumulative, total, count
+
+
+class Metrics(object):
+    """
+    Registry of labelled histograms and of values read on rendering.
+
+    ``gauge(name, kind, text, function)`` registers a counter or gauge,
+    ``function`` returns list of (labels dict, value) pairs.
+    """
+
+    def __init__(self):
+        self.descriptions = {}
+        self.histograms = {}
+        self.gauges = []
+        self.lock = Lock()
+
+    def describe(self, name, text):
+        """
+        Sets help text of a histogram.
+        """
+        self.descriptions[name] = text
+
+    def observe(self, name, value, **labels):
+        """
+        Adds value to histogram of given name and labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def gauge(self, name, kind, text, function):
+        """
+        Registers counter or gauge read by ``function`` on rendering.
+        """
+        self.gauges.append((name, kind, text, function))
+
+    def get(self, name, **labels):
+        """
+        Returns histogram of given name and labels or None.
+        """
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        last_name = None
+        for (name, labels), histogram in histograms:
+            if name != last_name:
+                lines.append('# HELP %s %s' % (
+                    name, self.descriptions.get(name, name),
+                ))
+                lines.append('# TYPE %s histogram' % name)
+                last_name = name
+            cumulative, total, count = histogram.samples()
+            for bound, bound_count in cumulative:
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', bound),)),
+                    bound_count,
+                ))
+            lines.append('%s_sum%s %s' % (
+                name, format_labels(labels), repr(total),
+            ))
+            lines.append('%s_count%s %d' % (
+                name, format_labels(labels), count,
+            ))
+        for name, kind, text, function in self.gauges:
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in function():
+                lines.append('%s%s %s' % (
+                    name, format_labels(sorted(labels.items())),
+                    format_value(value),
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+METRICS.describe(
+    'presence_request_duration_seconds', 'Request latency by endpoint.',
+)
+METRICS.describe(
+    'presence_stage_duration_seconds',
+    'Time spent in loading, fetching, aggregation and serialization.',
+)
+
+
+@contextmanager
+def timer(stage):
+    """
+    Records time spent in the block as given stage.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        METRICS.observe(
+            'presence_stage_duration_seconds', time.time() - start,
+            stage=stage,
+        )
+
+
+def timed(stage):
+    """
+    Records time spent in wrapped function as given stage.
+    """
+
+    def inner(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return inner
+    return inner
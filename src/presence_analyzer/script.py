@@ -2,6 +2,7 @@
 """Startup utilities"""
 # pylint:skip-file
 
+import ConfigParser
 import os
 import sys
 from functools import partial
@@ -28,8 +29,28 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.shared import SharedDataWatcher
+    from presence_analyzer.utils import get_snapshot
+    from presence_analyzer.watcher import start_watcher
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('DATA_STORE') == 'streaming':
+        # summaries are folded on demand, there is no dataset to watch
+        pass
+    elif app.config.get('DATA_SHARED_DIR'):
+        # workers forked after this call start their own watcher on first
+        # use, see get_watcher
+        start_watcher(
+            app.config['DATA_CSV'], app.config.get('DATA_WATCH_INTERVAL', 5),
+            get_snapshot(), factory=SharedDataWatcher,
+            directory=app.config['DATA_SHARED_DIR'],
+            workers=app.config.get('LOADER_WORKERS', 1),
+        )
+    elif app.config.get('DATA_WATCH_INTERVAL'):
+        start_watcher(
+            app.config['DATA_CSV'], app.config['DATA_WATCH_INTERVAL'],
+            get_snapshot(), workers=app.config.get('LOADER_WORKERS', 1),
+        )
     return app
 
 
@@ -78,6 +99,38 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _threadpool_options(config=DEPLOY_INI):
+    """Read Paste threadpool options of [server:main] from config."""
+    parser = ConfigParser.RawConfigParser()
+    parser.read(abspath(config))
+    options = {}
+    for name in ('workers', 'spawn_if_under', 'max_requests'):
+        option = 'threadpool_' + name
+        if parser.has_option('server:main', option):
+            options[name] = parser.getint('server:main', option)
+    return options
+
+
+def _bench(requests, concurrency, seed, **threadpool):
+    """Run load test, options below zero are read from deploy.ini."""
+    from presence_analyzer.benchmark.load import format_report, run_load
+    options = _threadpool_options()
+    options.update(
+        (name, value) for name, value in threadpool.items() if value >= 0
+    )
+    app = make_app()
+    print format_report(run_load(app, requests, concurrency, seed, **options))
+
+
+def _export(source, target):
+    """Export presence CSV to columnar file."""
+    from presence_analyzer import app
+    from presence_analyzer.snapshot import export_columns
+    app.config.from_pyfile(abspath(DEPLOY_CFG))
+    target = export_columns(source or app.config['DATA_CSV'], target or None)
+    print 'Exported to %s' % target
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
@@ -110,4 +163,37 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl bench --concurrency 20 --workers 10
+    def action_bench(requests=1000, concurrency=10, seed=0, workers=-1,
+                     spawn_if_under=-1, max_requests=-1):
+        """Load test the API on a local Paste threadpool server.
+
+        Sends random requests of API endpoints and users from concurrent
+        clients, reports requests per second, p50/p95/p99 latencies and
+        errors.
+
+        Options:
+         - '--requests' number of requests to send
+         - '--concurrency' number of concurrent clients
+         - '--seed' seed of the random requests
+         - '--workers', '--spawn-if-under', '--max-requests' threadpool
+           options, by default the ones of parts/etc/deploy.ini
+        """
+        _bench(requests, concurrency, seed, workers=workers,
+               spawn_if_under=spawn_if_under, max_requests=max_requests)
+
+    # bin/flask-ctl export --source presence.csv.gz
+    def action_export(source='', target=''):
+        """Export presence data to columnar file.
+
+        Columnar file set as DATA_CSV is mapped in memory instead of
+        parsing CSV.
+
+        Options:
+         - '--source' presence CSV, may be compressed, DATA_CSV by default
+         - '--target' columnar file, by default source path with .columns
+           extension
+        """
+        _export(source, target)
+
     werkzeug.script.run()
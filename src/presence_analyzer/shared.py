@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data shared by worker processes through memory-mapped segments.
+
+One of the processes using the same directory holds ``publisher.lock``.
+It parses the CSV and writes every new dataset, summaries included, as
+segment file ``segment.<generation>`` in snapshot format, then points
+``current`` at it. All processes, the publisher too, map the current
+segment read-only, so the data is in memory once whatever the number of
+workers. When the publisher exits another process takes the lock over.
+"""
+import errno
+import fcntl
+import glob
+import logging
+import os
+
+from presence_analyzer.snapshot import NO_SOURCE, dataset_columns, \
+    dataset_from_columns, read_columns, write_columns
+from presence_analyzer.watcher import DataWatcher
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class SharedDataWatcher(DataWatcher):
+    """
+    Watcher publishing datasets to and attaching them from shared segments.
+    """
+
+    def __init__(self, path, directory, interval, snapshot=None, workers=1):
+        super(SharedDataWatcher, self).__init__(
+            path, interval, snapshot, workers,
+        )
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.lock_file = None
+        self.published = None
+        self.generation = None
+
+    def segment_path(self, generation):
+        """
+        Returns path of segment file of given generation.
+        """
+        return os.path.join(self.directory, 'segment.%d' % generation)
+
+    def is_publisher(self):
+        """
+        Checks if this process holds the publisher lock, tries to take it.
+        """
+        if self.lock_file is not None:
+            return True
+        lock_file = open(os.path.join(self.directory, 'publisher.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            lock_file.close()
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        log.info('Process %d publishes presence data', os.getpid())
+        self.lock_file = lock_file
+        return True
+
+    def current_generation(self):
+        """
+        Returns generation of the current segment, None if there is none.
+        """
+        try:
+            with open(os.path.join(self.directory, 'current')) as current:
+                return int(current.read())
+        except (IOError, ValueError):
+            return None
+
+    def publish(self, dataset):
+        """
+        Writes dataset segment, makes it current and removes older ones.
+        """
+        generation = dataset.version
+        write_columns(
+            self.segment_path(generation), NO_SOURCE,
+            dataset_columns(dataset),
+        )
+        current = os.path.join(self.directory, 'current')
+        with open(current + '.tmp', 'w') as pointer:
+            pointer.write(str(generation))
+        os.rename(current + '.tmp', current)
+        self.published = generation
+        # mapped segments stay readable for workers after unlinking
+        for path in glob.glob(os.path.join(self.directory, 'segment.*')):
+            if path != self.segment_path(generation):
+                os.remove(path)
+
+    def attach(self):
+        """
+        Maps current segment if it is newer than the attached one.
+        """
+        generation = self.current_generation()
+        if generation is None or generation == self.generation:
+            return False
+        segment = read_columns(self.segment_path(generation))
+        dataset = segment and dataset_from_columns(segment[1], generation)
+        if dataset is None:
+            log.warning('Cannot attach segment %d', generation)
+            return False
+        self.dataset = dataset
+        self.generation = generation
+        log.debug('Attached presence data segment %d', generation)
+        return True
+
+    def reload(self):
+        """
+        Publishes changes when publisher, then attaches current segment.
+        """
+        if self.is_publisher():
+            dataset = self.ingester.update()
+            if dataset.version != self.published:
+                self.publish(dataset)
+        return self.attach()
+
+    def abandon(self):
+        """
+        Closes copy of publisher lock file inherited from the parent.
+
+        The lock stays with the parent, it is released only when all its
+        descriptors are closed.
+        """
+        super(SharedDataWatcher, self).abandon()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stop(self):
+        """
+        Stops polling thread and gives publisher lock up.
+        """
+        super(SharedDataWatcher, self).stop()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot file layout (little endian)::
+
+    header   magic, format version, CSV size, mtime, SHA-1, parsed offset,
+             parsed lines, number of columns
+    columns  name, typecode, item size, data offset and length per column
+    data     raw column values, each column aligned to 8 bytes
+
+Columns are mapped with ``mmap`` and used in place as ``ctypes`` arrays,
+so loading a snapshot does not copy or parse the data. Besides the store
+columns a snapshot keeps weekday summaries, named with ``w:`` prefix, and
+team rollup with daily headcount, named with ``t:`` prefix.
+
+The same format without source CSV is the columnar presence file, with
+``.columns`` extension, which can be used instead of the CSV.
+"""
+import array
+import ctypes
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from threading import Lock
+
+from presence_analyzer.dataset import Dataset, merge_dataset
+from presence_analyzer.loader import file_hash, get_decompressor, read_data
+from presence_analyzer.metrics import timed
+from presence_analyzer.stats import TeamStats, WeekdayStats
+from presence_analyzer.store import PresenceStore
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIQd20sQQI')
+COLUMN = struct.Struct('<16scBQQ')
+ALIGNMENT = 8
+STORE_COLUMNS = ('users', 'offsets', 'days', 'starts', 'ends')
+STATS_PREFIX = 'w:'
+TEAM_PREFIX = 't:'
+NO_SOURCE = (0, 0.0, '', 0, 0)
+COLUMNS_EXTENSION = '.columns'
+CTYPES = {
+    ('i', 4): ctypes.c_int32, ('l', 4): ctypes.c_int32,
+    ('i', 8): ctypes.c_int64, ('l', 8): ctypes.c_int64,
+    ('d', 8): ctypes.c_double,
+}
+# typecodes of mapped columns, written again by shared segment publishers
+CTYPECODES = {ctypes.c_int32: 'i', ctypes.c_int64: 'l', ctypes.c_double: 'd'}
+
+
+def aligned(offset):
+    """
+    Rounds offset up to ``ALIGNMENT``.
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def column_format(column):
+    """
+    Returns (typecode, item size) of ``array`` or mapped ``ctypes`` column.
+    """
+    if isinstance(column, array.array):
+        return column.typecode, column.itemsize
+    item_type = column._type_  # pylint: disable=protected-access
+    return CTYPECODES[item_type], ctypes.sizeof(item_type)
+
+
+def write_columns(path, key, columns):
+    """
+    Writes snapshot of named columns atomically.
+
+    ``key`` is (size, mtime, sha1, offset, lines) of the source CSV or
+    ``NO_SOURCE``. Columns are ``array`` or mapped ``ctypes`` arrays.
+    """
+    data_start = aligned(HEADER.size + COLUMN.size * len(columns))
+    entries = []
+    position = data_start
+    for name, column in columns:
+        typecode, itemsize = column_format(column)
+        entries.append((name, column, typecode, itemsize, position))
+        position = aligned(position + len(column) * itemsize)
+    handle, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.snapshot',
+    )
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            output.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, key[0], key[1], key[2], key[3],
+                key[4], len(columns),
+            ))
+            for name, column, typecode, itemsize, offset in entries:
+                output.write(COLUMN.pack(
+                    name, typecode, itemsize, offset, len(column),
+                ))
+            for _, column, _, _, offset in entries:
+                output.write('\0' * (offset - output.tell()))
+                output.write(buffer(column))
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def read_columns(path):
+    """
+    Maps snapshot file, returns (key, columns by name).
+
+    Returns None when the file is missing or not a snapshot of this format.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            mapped = mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_COPY,
+            )
+    except (IOError, OSError, ValueError):
+        return None
+    if len(mapped) < HEADER.size:
+        return None
+    header = HEADER.unpack_from(mapped, 0)
+    if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+        log.info('Ignoring snapshot %s of other format', path)
+        return None
+    columns = {}
+    for i in xrange(header[7]):
+        name, typecode, itemsize, offset, length = COLUMN.unpack_from(
+            mapped, HEADER.size + i * COLUMN.size,
+        )
+        if offset + length * itemsize > len(mapped):
+            log.warning('Snapshot %s is truncated', path)
+            return None
+        columns[name.rstrip('\0')] = \
+            (CTYPES[typecode, itemsize] * length).from_buffer(mapped, offset)
+    return header[2:7], columns
+
+
+def dataset_columns(dataset):
+    """
+    Returns named columns of dataset store and summaries.
+    """
+    columns = [
+        (name, getattr(dataset.store, name)) for name in STORE_COLUMNS
+    ]
+    columns.extend(
+        (STATS_PREFIX + name, column)
+        for name, column in sorted(dataset.weekday_stats.columns.items())
+    )
+    columns.extend(
+        (TEAM_PREFIX + name, column)
+        for name, column in sorted(dataset.team_stats.columns().items())
+    )
+    return columns
+
+
+def dataset_from_columns(columns, version=None):
+    """
+    Builds dataset from named columns, returns None when some are missing.
+
+    Summaries are computed again if the columns do not have them.
+    """
+    if not all(name in columns for name in STORE_COLUMNS):
+        return None
+    store = PresenceStore(*[columns[name] for name in STORE_COLUMNS])
+    stats_columns = prefixed_columns(columns, STATS_PREFIX)
+    team_columns = prefixed_columns(columns, TEAM_PREFIX)
+    weekday_stats = team_stats = None
+    if stats_columns:
+        weekday_stats = WeekdayStats(store.users, stats_columns)
+        if team_columns:
+            team_stats = TeamStats.from_columns(team_columns)
+    return Dataset(store, weekday_stats=weekday_stats, version=version,
+                   team_stats=team_stats)
+
+
+def prefixed_columns(columns, prefix):
+    """
+    Returns columns of names with given prefix, by names without it.
+    """
+    return dict(
+        (name[len(prefix):], column) for name, column in columns.items()
+        if name.startswith(prefix)
+    )
+
+
+class DatasetSnapshot(object):
+    """
+    Snapshot of a ``Dataset`` stored next to the CSV file.
+
+    Snapshot is valid for CSV which starts with the bytes it was written
+    from, same size and SHA-1 of them, so rows appended since do not make
+    it outdated. It is read by ``CsvIngester`` instead of parsing the file
+    from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, csvfile, stat):
+        """
+        Returns (dataset, offset, lines) for given CSV file or None.
+        """
+        snapshot = read_columns(self.path)
+        if snapshot is None:
+            return None
+        key, columns = snapshot
+        size, _, sha1, offset, lines = key
+        if stat.st_size < size or sha1 != file_hash(csvfile, size):
+            log.info('Snapshot %s is outdated', self.path)
+            return None
+        dataset = dataset_from_columns(columns)
+        if dataset is None:
+            return None
+        return dataset, offset, lines
+
+    def save(self, stat, digest, dataset, offset, lines):
+        """
+        Writes snapshot of dataset parsed from whole CSV with given SHA-1.
+        """
+        key = (stat.st_size, stat.st_mtime, digest, offset, lines)
+        write_columns(self.path, key, dataset_columns(dataset))
+
+
+def is_columnar(path):
+    """
+    Checks if path is of a columnar presence file.
+    """
+    return path.endswith(COLUMNS_EXTENSION)
+
+
+def read_dataset(path):
+    """
+    Maps columnar presence file, returns its dataset.
+
+    Raises IOError when the file is missing or of other format.
+    """
+    snapshot = read_columns(path)
+    dataset = snapshot and dataset_from_columns(snapshot[1])
+    if dataset is None:
+        raise IOError('%s is not a columnar presence file' % path)
+    return dataset
+
+
+def export_columns(source, target=None):
+    """
+    Converts presence CSV, compressed one too, to columnar file.
+
+    By default the target is the source path with ``.columns`` extension
+    instead of the CSV and compression ones. Returns the target path.
+    """
+    if target is None:
+        target = source
+        if get_decompressor(target) is not None:
+            target = os.path.splitext(target)[0]
+        target = os.path.splitext(target)[0] + COLUMNS_EXTENSION
+    dataset = read_data(source, merge_dataset)
+    write_columns(target, NO_SOURCE, dataset_columns(dataset))
+    return target
+
+
+class ColumnarIngester(object):
+    """
+    Reader of columnar presence file with ``CsvIngester`` interface.
+
+    The file is mapped again after it is replaced, exports write a new
+    file and rename it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.identity = None
+        self.data = None
+        self.lock = Lock()
+
+    @timed('columnar_ingest')
+    def update(self):
+        """
+        Returns dataset of the current file.
+        """
+        with self.lock:
+            stat = os.stat(self.path)
+            identity = (
+                stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime,
+            )
+            if identity != self.identity:
+                self.data = read_dataset(self.path)
+                self.identity = identity
+            return self.data
@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+"""
+Weekday statistics computed from the columnar presence store.
+"""
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+
+from presence_analyzer.store import DAY_TYPE, OFFSET_TYPE, to_seconds
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_PERCENTILES = (50, 90)
+COUNT_TYPE = 'l'
+VALUE_TYPE = 'd'
+SECONDS_PER_DAY = 24 * 60 * 60
+# statistics which can be folded from rows one at a time
+RUNNING_COLUMNS = ('count', 'total', 'min', 'max', 'start_total', 'end_total')
+# statistics of date windows computed from prefix sums alone
+SUM_COLUMNS = (
+    'count', 'total', 'mean', 'start_total', 'end_total', 'start_mean',
+    'end_mean',
+)
+# statistics of users rolled up by ``TeamStats.weekday_rollup``
+ROLLUP_COLUMNS = ('count', 'total', 'mean', 'start_total', 'end_total')
+# team rollup values which are whole numbers, the others are floats
+TEAM_COUNT_COLUMNS = ('users', 'count', 'total', 'start_total', 'end_total')
+# daily team columns besides the weekday rollup
+TEAM_DAILY_COLUMNS = ('first_day', 'headcount', 'totals')
+
+
+def weekday(ordinal):
+    """
+    Returns weekday of a day ordinal, Monday is 0.
+    """
+    return (ordinal - 1) % 7
+
+
+def percentile(ordered, rank):
+    """
+    Returns percentile of sorted values with linear interpolation.
+    """
+    if not ordered:
+        return 0
+    position = (len(ordered) - 1) * rank / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * \
+        (position - lower)
+
+
+def count_days(first, last, weekdays=None):
+    """
+    Counts days of given weekdays (all by default) within inclusive range
+    of ordinals.
+    """
+    if last < first:
+        return 0
+    weeks, rest = divmod(last - first + 1, 7)
+    if weekdays is None:
+        return weeks * 7 + rest
+    return weeks * len(weekdays) + sum(
+        1 for day in xrange(last - rest + 1, last + 1)
+        if weekday(day) in weekdays
+    )
+
+
+def occupancy(store, bucket, weekdays=None, first=None, last=None):
+    """
+    Counts presence in every ``bucket`` seconds long part of the day.
+
+    Presence is counted in every bucket it overlaps. Only days of given
+    weekdays and within inclusive range of ordinals (None is open) are
+    counted. Rows are swept once into a difference array, so the cost is
+    O(rows + buckets). Returns (counts, number of calendar days of the
+    weekdays in the range), the range is limited to days of the store.
+    """
+    delta = [0] * (SECONDS_PER_DAY // bucket + 1)
+    first_day = last_day = None
+    for user_id in store.users:
+        start, stop = store.rows(user_id)
+        if start == stop:
+            continue
+        # rows of a user are sorted by day
+        if first_day is None or store.days[start] < first_day:
+            first_day = store.days[start]
+        last_day = max(last_day, store.days[stop - 1])
+        if first is not None:
+            start = bisect_left(store.days, first, start, stop)
+        if last is not None:
+            stop = bisect_right(store.days, last, start, stop)
+        for i in xrange(start, stop):
+            day = store.days[i]
+            if weekdays is not None and weekday(day) not in weekdays:
+                continue
+            if store.ends[i] <= store.starts[i]:
+                continue
+            delta[store.starts[i] // bucket] += 1
+            delta[(store.ends[i] - 1) // bucket + 1] -= 1
+    counts = []
+    present = 0
+    for change in delta[:-1]:
+        present += change
+        counts.append(present)
+    if first_day is None:
+        return counts, 0
+    if first is not None:
+        first_day = max(first_day, first)
+    if last is not None:
+        last_day = min(last_day, last)
+    return counts, count_days(first_day, last_day, weekdays)
+
+
+class WeekdayStats(object):
+    """
+    Presence time statistics per (user, weekday).
+
+    Every statistic is an array of ``len(users) * 7`` values, value for
+    ``users[i]`` and weekday ``d`` is at ``i * 7 + d``. Percentile
+    columns are named ``p50``, ``p90`` and so on. ``start_total`` and
+    ``start_mean`` (``end_*`` as well) are sums and means of start times in
+    seconds since midnight.
+    """
+
+    def __init__(self, users, columns):
+        self.users = users
+        self.columns = columns
+        self.positions = dict((uid, i) for i, uid in enumerate(users))
+
+    @classmethod
+    def from_store(cls, store, percentiles=DEFAULT_PERCENTILES):
+        """
+        Computes statistics of all users in one pass over store columns.
+        """
+        columns = cls.empty_columns(len(store.users) * 7, percentiles)
+        for position, user_id in enumerate(store.users):
+            cls.fill_user(columns, position, store, user_id, percentiles)
+        return cls(store.users, columns)
+
+    def merge(self, store, touched):
+        """
+        Returns statistics of a store which differs from the one of these
+        statistics only in rows of ``touched`` user ids.
+
+        Only statistics of touched users are computed, values of other
+        users are copied.
+        """
+        percentiles = self.percentiles
+        columns = self.empty_columns(len(store.users) * 7, percentiles)
+        for position, user_id in enumerate(store.users):
+            if user_id in touched or user_id not in self.positions:
+                self.fill_user(columns, position, store, user_id, percentiles)
+                continue
+            k = position * 7
+            old = self.positions[user_id] * 7
+            for name, column in columns.iteritems():
+                column[k:k + 7] = array(
+                    column.typecode, self.columns[name][old:old + 7],
+                )
+        return WeekdayStats(store.users, columns)
+
+    @staticmethod
+    def empty_columns(size, percentiles):
+        """
+        Returns dict of zeroed statistic columns of given size.
+        """
+        columns = {
+            'count': array(COUNT_TYPE, [0]) * size,
+            'total': array(COUNT_TYPE, [0]) * size,
+            'min': array(COUNT_TYPE, [0]) * size,
+            'max': array(COUNT_TYPE, [0]) * size,
+            'mean': array(VALUE_TYPE, [0]) * size,
+            'start_total': array(COUNT_TYPE, [0]) * size,
+            'end_total': array(COUNT_TYPE, [0]) * size,
+            'start_mean': array(VALUE_TYPE, [0]) * size,
+            'end_mean': array(VALUE_TYPE, [0]) * size,
+        }
+        for rank in percentiles:
+            columns['p%d' % rank] = array(VALUE_TYPE, [0]) * size
+        return columns
+
+    @staticmethod
+    def fill_user(columns, position, store, user_id, percentiles):
+        """
+        Computes statistics of one user of the store at given position.
+        """
+        days, starts, ends = store.days, store.starts, store.ends
+        start, stop = store.rows(user_id)
+        intervals = [[], [], [], [], [], [], []]
+        start_totals = [0] * 7
+        end_totals = [0] * 7
+        for i in xrange(start, stop):
+            day = weekday(days[i])
+            intervals[day].append(ends[i] - starts[i])
+            start_totals[day] += starts[i]
+            end_totals[day] += ends[i]
+        for day, values in enumerate(intervals):
+            if not values:
+                continue
+            values.sort()
+            k = position * 7 + day
+            columns['count'][k] = len(values)
+            columns['total'][k] = sum(values)
+            columns['start_total'][k] = start_totals[day]
+            columns['end_total'][k] = end_totals[day]
+            columns['start_mean'][k] = float(start_totals[day]) / len(values)
+            columns['end_mean'][k] = float(end_totals[day]) / len(values)
+            columns['min'][k] = values[0]
+            columns['max'][k] = values[-1]
+            columns['mean'][k] = float(columns['total'][k]) / len(values)
+            for rank in percentiles:
+                columns['p%d' % rank][k] = percentile(values, rank)
+
+    @property
+    def percentiles(self):
+        """
+        Ranks of percentile columns, in ascending order.
+        """
+        return sorted(
+            int(name[1:]) for name in self.columns
+            if name.startswith('p') and name[1:].isdigit()
+        )
+
+    def __contains__(self, user_id):
+        return user_id in self.positions
+
+    def get(self, user_id, name):
+        """
+        Returns list of seven weekday values of given statistic and user.
+        """
+        k = self.positions[user_id] * 7
+        return list(self.columns[name][k:k + 7])
+
+    def user(self, user_id):
+        """
+        Returns all statistics of given user by name.
+        """
+        return dict((name, self.get(user_id, name)) for name in self.columns)
+
+
+class TeamStats(object):
+    """
+    Presence of all users together, rolled up when the dataset is built.
+
+    ``weekdays`` maps names to seven values per weekday: ``users`` with
+    any presence, ``count`` of their days, ``total``, ``start_total`` and
+    ``end_total`` seconds, ``mean``, ``start_mean`` and ``end_mean`` per
+    day, and ``pNN`` percentiles of user mean presence time, so spread
+    between users. ``headcount`` and ``totals`` hold number of users
+    present and their presence time for every day from ``first_day``
+    ordinal on.
+
+    Rollups are kept in snapshots as ``columns()`` and read back by
+    ``from_columns``.
+    """
+
+    def __init__(self, weekdays, first_day, headcount, totals):
+        self.weekdays = weekdays
+        self.first_day = first_day
+        self.headcount = headcount
+        self.totals = totals
+
+    @classmethod
+    def from_store(cls, store, weekday_stats, percentiles=None):
+        """
+        Rolls summaries of all users up, counts store rows per day.
+
+        Percentiles of user means are those of ``weekday_stats`` by
+        default. Store can be None, there is no daily headcount then.
+        """
+        if percentiles is None:
+            percentiles = weekday_stats.percentiles
+        weekdays = cls.weekday_rollup(
+            (weekday_stats.user(user_id) for user_id in weekday_stats.users),
+            percentiles,
+        )
+        headcount = array(COUNT_TYPE)
+        totals = array(COUNT_TYPE)
+        first_day = None
+        if store is not None and len(store.days):
+            first_day = min(store.days)
+            size = max(store.days) - first_day + 1
+            headcount = array(COUNT_TYPE, [0]) * size
+            totals = array(COUNT_TYPE, [0]) * size
+            for day, start, end in zip(store.days, store.starts, store.ends):
+                headcount[day - first_day] += 1
+                totals[day - first_day] += end - start
+        return cls(weekdays, first_day, headcount, totals)
+
+    def merge(self, old_store, store, touched, weekday_stats,
+              percentiles=None):
+        """
+        Returns rollup of a store which differs from ``old_store``, the
+        one of this rollup, only in rows of ``touched`` user ids.
+
+        Weekdays are rolled up again from ``weekday_stats``, only rows of
+        touched users are counted again in the daily headcount.
+        """
+        if percentiles is None:
+            percentiles = weekday_stats.percentiles
+        weekdays = self.weekday_rollup(
+            (weekday_stats.user(user_id) for user_id in weekday_stats.users),
+            percentiles,
+        )
+        first_day = self.first_day
+        headcount = array(COUNT_TYPE, self.headcount)
+        totals = array(COUNT_TYPE, self.totals)
+        for user_id in touched:
+            start, stop = store.rows(user_id)
+            if start == stop:
+                continue
+            # rows of a user are sorted by day
+            first, last = store.days[start], store.days[stop - 1]
+            if first_day is None:
+                first_day = first
+            if first < first_day:
+                padding = array(COUNT_TYPE, [0]) * (first_day - first)
+                headcount = padding + headcount
+                totals = padding + totals
+                first_day = first
+            if last - first_day >= len(headcount):
+                padding = array(COUNT_TYPE, [0]) * \
+                    (last - first_day + 1 - len(headcount))
+                headcount.extend(padding)
+                totals.extend(padding)
+        for rows, sign in ((old_store, -1), (store, 1)):
+            for user_id in touched:
+                start, stop = rows.rows(user_id)
+                for i in xrange(start, stop):
+                    headcount[rows.days[i] - first_day] += sign
+                    totals[rows.days[i] - first_day] += sign * (
+                        rows.ends[i] - rows.starts[i]
+                    )
+        return TeamStats(weekdays, first_day, headcount, totals)
+
+    @staticmethod
+    def weekday_rollup(users, percentiles=()):
+        """
+        Sums statistics of users, given like ``WeekdayStats.user()``
+        returns them, into weekday rollup.
+        """
+        names = TEAM_COUNT_COLUMNS
+        result = dict((name, [0] * 7) for name in names)
+        means = [[], [], [], [], [], [], []]
+        for values in users:
+            for day in xrange(7):
+                if not values['count'][day]:
+                    continue
+                result['users'][day] += 1
+                for name in names[1:]:
+                    result[name][day] += values[name][day]
+                means[day].append(values['mean'][day])
+        counts = result['count']
+        for name, total in (('mean', 'total'), ('start_mean', 'start_total'),
+                            ('end_mean', 'end_total')):
+            result[name] = [
+                float(value) / count if count else 0.0
+                for value, count in zip(result[total], counts)
+            ]
+        for day_means in means:
+            day_means.sort()
+        for rank in percentiles:
+            result['p%d' % rank] = [
+                float(percentile(day_means, rank)) for day_means in means
+            ]
+        return result
+
+    def columns(self):
+        """
+        Returns arrays of the rollup and of daily values by name.
+        """
+        columns = dict(
+            (name, array(
+                COUNT_TYPE if name in TEAM_COUNT_COLUMNS else VALUE_TYPE,
+                values,
+            ))
+            for name, values in self.weekdays.iteritems()
+        )
+        columns['first_day'] = array(
+            COUNT_TYPE, [] if self.first_day is None else [self.first_day],
+        )
+        columns['headcount'] = self.headcount
+        columns['totals'] = self.totals
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Builds rollup from arrays returned by ``columns()``, daily arrays
+        are used in place.
+        """
+        weekdays = dict(
+            (name, list(column)) for name, column in columns.iteritems()
+            if name not in TEAM_DAILY_COLUMNS
+        )
+        first_day = None
+        if len(columns['first_day']):
+            first_day = columns['first_day'][0]
+        return cls(
+            weekdays, first_day, columns['headcount'], columns['totals'],
+        )
+
+    def days(self, first=None, last=None):
+        """
+        Returns (ordinal, headcount, total) of days within inclusive range
+        of ordinals, None is open.
+        """
+        if self.first_day is None:
+            return []
+        start = 0 if first is None else max(first - self.first_day, 0)
+        stop = len(self.headcount)
+        if last is not None:
+            stop = min(last - self.first_day + 1, stop)
+        return [
+            (self.first_day + i, self.headcount[i], self.totals[i])
+            for i in xrange(start, stop)
+        ]
+
+
+class WeekdayIndex(object):
+    """
+    Rows grouped by (user, weekday) and sorted by day, with prefix sums.
+
+    Rows of ``users[i]`` on weekday ``d`` are ``offsets[i * 7 + d]`` up to
+    the next offset, ``days`` holds their ordinals. ``totals``,
+    ``start_totals`` and ``end_totals`` have one more item: ``totals[j]``
+    is the sum of presence time of all rows before ``j``. Days of a range
+    are found by binary search and their sums are differences of two
+    prefix sums.
+    """
+
+    def __init__(self, users, offsets, days, totals, start_totals,
+                 end_totals):
+        self.users = users
+        self.offsets = offsets
+        self.days = days
+        self.totals = totals
+        self.start_totals = start_totals
+        self.end_totals = end_totals
+        self.positions = dict((uid, i) for i, uid in enumerate(users))
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Builds index of all users of the store.
+        """
+        offsets = array(OFFSET_TYPE, [0])
+        days = array(DAY_TYPE)
+        # sums of many rows do not fit in 32 bits, doubles are exact
+        totals = array(VALUE_TYPE, [0])
+        start_totals = array(VALUE_TYPE, [0])
+        end_totals = array(VALUE_TYPE, [0])
+        for user_id in store.users:
+            start, stop = store.rows(user_id)
+            weekdays = [[], [], [], [], [], [], []]
+            for i in xrange(start, stop):
+                weekdays[weekday(store.days[i])].append(i)
+            for rows in weekdays:
+                for i in rows:
+                    days.append(store.days[i])
+                    totals.append(
+                        totals[-1] + store.ends[i] - store.starts[i],
+                    )
+                    start_totals.append(start_totals[-1] + store.starts[i])
+                    end_totals.append(end_totals[-1] + store.ends[i])
+                offsets.append(len(days))
+        return cls(
+            store.users, offsets, days, totals, start_totals, end_totals,
+        )
+
+    def __contains__(self, user_id):
+        return user_id in self.positions
+
+    def find(self, user_id, day, first=None, last=None):
+        """
+        Returns (start, stop) rows of user and weekday within given range.
+
+        ``first`` and ``last`` are inclusive day ordinals, None is open.
+        """
+        k = self.positions[user_id] * 7 + day
+        start, stop = self.offsets[k], self.offsets[k + 1]
+        if first is not None:
+            start = bisect_left(self.days, first, start, stop)
+        if last is not None:
+            stop = bisect_right(self.days, last, start, stop)
+        return start, stop
+
+    def window(self, user_id, first=None, last=None, names=SUM_COLUMNS):
+        """
+        Returns given statistics of user by name for days within range.
+
+        Statistics are named like ``WeekdayStats`` columns. Those of
+        ``SUM_COLUMNS`` cost two binary searches per weekday, ``min``,
+        ``max`` and percentiles also sort presence times of the range.
+        """
+        result = dict((name, [0] * 7) for name in names)
+        ranks = [
+            int(name[1:]) for name in names
+            if name.startswith('p') and name[1:].isdigit()
+        ]
+        ordered = ranks or 'min' in result or 'max' in result
+        totals = self.totals
+        for day in xrange(7):
+            start, stop = self.find(user_id, day, first, last)
+            count = stop - start
+            if not count:
+                continue
+            total = int(totals[stop] - totals[start])
+            start_total = int(self.start_totals[stop] -
+                              self.start_totals[start])
+            end_total = int(self.end_totals[stop] - self.end_totals[start])
+            sums = {
+                'count': count, 'total': total, 'mean': float(total) / count,
+                'start_total': start_total, 'end_total': end_total,
+                'start_mean': float(start_total) / count,
+                'end_mean': float(end_total) / count,
+            }
+            if ordered:
+                values = sorted(
+                    int(totals[i + 1] - totals[i])
+                    for i in xrange(start, stop)
+                )
+                sums['min'] = values[0]
+                sums['max'] = values[-1]
+                for rank in ranks:
+                    sums['p%d' % rank] = percentile(values, rank)
+            for name, column in result.iteritems():
+                column[day] = sums[name]
+        return result
+
+
+class WeekdayAccumulator(object):
+    """
+    Running weekday statistics folded from rows one at a time.
+
+    Only sums, counts, minima and maxima per (user, weekday) are kept, so
+    memory does not grow with the number of rows. Percentiles would need
+    every value and are not available.
+
+    The last row of every user is held back until a row of a later day
+    comes, so a repeated (user, day) replaces the earlier row like in
+    ``merge_rows``. That needs rows of every user in day order, as the
+    presence log is written. Repeated days of rows out of order are
+    counted twice, ``unordered`` is then set.
+    """
+
+    def __init__(self):
+        self.users = []
+        self.positions = {}
+        self.columns = dict(
+            (name, array(COUNT_TYPE)) for name in RUNNING_COLUMNS
+        )
+        self.pending = {}
+        self.unordered = False
+
+    def add(self, user_id, day, start, end):
+        """
+        Takes one (user_id, date, start, end) row.
+        """
+        row = (day.toordinal(), to_seconds(start), to_seconds(end))
+        pending = self.pending.get(user_id)
+        if pending is not None and pending[0] != row[0]:
+            if row[0] < pending[0] and not self.unordered:
+                log.warning('Rows of user %s are not in day order, '
+                            'repeated days may be counted twice', user_id)
+                self.unordered = True
+            self.fold(user_id, *pending)
+        self.pending[user_id] = row
+
+    def fold(self, user_id, ordinal, start, end):
+        """
+        Folds one row, day is an ordinal and times are in seconds.
+        """
+        position = self.positions.get(user_id)
+        if position is None:
+            position = self.positions[user_id] = len(self.users)
+            self.users.append(user_id)
+            for column in self.columns.itervalues():
+                column.extend(array(COUNT_TYPE, [0]) * 7)
+        k = position * 7 + weekday(ordinal)
+        value = end - start
+        columns = self.columns
+        if not columns['count'][k] or value < columns['min'][k]:
+            columns['min'][k] = value
+        if not columns['count'][k] or value > columns['max'][k]:
+            columns['max'][k] = value
+        columns['count'][k] += 1
+        columns['total'][k] += value
+        columns['start_total'][k] += start
+        columns['end_total'][k] += end
+
+    def to_stats(self):
+        """
+        Returns ``WeekdayStats`` of all rows, users in ascending order.
+        """
+        for user_id, row in self.pending.iteritems():
+            self.fold(user_id, *row)
+        self.pending = {}
+        users = sorted(self.users)
+        columns = dict(
+            (name, array(COUNT_TYPE)) for name in RUNNING_COLUMNS
+        )
+        for user_id in users:
+            k = self.positions[user_id] * 7
+            for name, column in columns.iteritems():
+                column.extend(self.columns[name][k:k + 7])
+        counts = columns['count']
+        for name, total in (('mean', 'total'), ('start_mean', 'start_total'),
+                            ('end_mean', 'end_total')):
+            columns[name] = array(VALUE_TYPE, (
+                float(value) / count if count else 0
+                for value, count in zip(columns[total], counts)
+            ))
+        return WeekdayStats(users, columns)
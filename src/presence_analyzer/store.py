@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar presence data store.
+"""
+import collections
+import ctypes
+from array import array
+from datetime import date, time
+
+# typecodes of 32-bit signed integers
+USER_TYPE = DAY_TYPE = SECONDS_TYPE = 'i'
+OFFSET_TYPE = 'l'
+
+
+def to_seconds(value):
+    """
+    Converts datetime.time to seconds since midnight.
+    """
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def to_time(seconds):
+    """
+    Converts seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def column_nbytes(column):
+    """
+    Returns size of ``array`` or ``ctypes`` array column in bytes.
+    """
+    if isinstance(column, array):
+        return len(column) * column.itemsize
+    return ctypes.sizeof(column)
+
+
+class PresenceStore(collections.Mapping):
+    """
+    Presence rows kept in typed arrays.
+
+    Rows are sorted by user id and day ordinal, ``users`` holds sorted ids
+    and rows of ``users[i]`` are ``offsets[i]:offsets[i + 1]``. Each row
+    takes 16 bytes. Columns are ``array`` objects or ``ctypes`` arrays
+    mapped from a snapshot.
+
+    For compatibility the store is a read-only mapping with the same
+    content as ``get_data()``: ``store[user_id]`` builds the
+    ``{date: {'start': time, 'end': time}}`` dict of given user.
+    """
+
+    def __init__(self, users, offsets, days, starts, ends):
+        self.users = users
+        self.offsets = offsets
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.positions = dict((uid, i) for i, uid in enumerate(users))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, date, start, end) tuples.
+
+        Later rows win when user and day repeat, like in ``get_data()``.
+        """
+        return cls.from_user_columns(user_columns(rows))
+
+    @classmethod
+    def from_user_columns(cls, columns):
+        """
+        Builds store from dict of (days, starts, ends) arrays by user id.
+
+        Later rows win when user and day repeat.
+        """
+        users = array(USER_TYPE, sorted(columns))
+        offsets = array(OFFSET_TYPE, [0])
+        days = array(DAY_TYPE)
+        starts = array(SECONDS_TYPE)
+        ends = array(SECONDS_TYPE)
+        for user_id in users:
+            user_days, user_starts, user_ends = sort_days(*columns[user_id])
+            days.extend(user_days)
+            starts.extend(user_starts)
+            ends.extend(user_ends)
+            offsets.append(len(days))
+        return cls(users, offsets, days, starts, ends)
+
+    def user_columns(self, user_id):
+        """
+        Returns (days, starts, ends) arrays of given user.
+        """
+        start, stop = self.rows(user_id)
+        return (
+            self.days[start:stop],
+            self.starts[start:stop],
+            self.ends[start:stop],
+        )
+
+    def merge(self, rows):
+        """
+        Returns new store with given rows added.
+        """
+        return self.merge_columns(user_columns(rows))
+
+    def merge_columns(self, columns):
+        """
+        Returns new store with dict of (days, starts, ends) arrays by user
+        id added, self when there are none.
+
+        Rows of users without new rows are copied unchanged, only rows of
+        users given are sorted again.
+        """
+        if not columns:
+            return self
+        users = array(USER_TYPE, sorted(set(self.users) | set(columns)))
+        offsets = array(OFFSET_TYPE, [0])
+        merged = (array(DAY_TYPE), array(SECONDS_TYPE), array(SECONDS_TYPE))
+        current = (self.days, self.starts, self.ends)
+        for user_id in users:
+            start, stop = self.rows(user_id)
+            if user_id in columns:
+                user = [
+                    copy_rows(array(column.typecode), old, start, stop)
+                    for column, old in zip(merged, current)
+                ]
+                for column, new in zip(user, columns[user_id]):
+                    column.extend(new)
+                for column, new in zip(merged, sort_days(*user)):
+                    column.extend(new)
+            else:
+                for column, old in zip(merged, current):
+                    copy_rows(column, old, start, stop)
+            offsets.append(len(merged[0]))
+        return PresenceStore(users, offsets, *merged)
+
+    def rows(self, user_id):
+        """
+        Returns (start, stop) range of rows of given user.
+        """
+        i = self.positions.get(user_id)
+        if i is None:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    def nbytes(self):
+        """
+        Returns size of arrays in bytes.
+        """
+        return sum(
+            column_nbytes(column) for column in (
+                self.users, self.offsets, self.days, self.starts, self.ends,
+            )
+        )
+
+    def __getitem__(self, user_id):
+        if user_id not in self.positions:
+            raise KeyError(user_id)
+        start, stop = self.rows(user_id)
+        return dict(
+            (date.fromordinal(self.days[i]), {
+                'start': to_time(self.starts[i]),
+                'end': to_time(self.ends[i]),
+            })
+            for i in xrange(start, stop)
+        )
+
+    def __contains__(self, user_id):
+        return user_id in self.positions
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def keys(self):
+        return list(self.users)
+
+
+def user_columns(rows):
+    """
+    Groups (user_id, date, start, end) tuples into dict of (days, starts,
+    ends) arrays by user id, keeping order of rows.
+    """
+    columns = {}
+    for user_id, day, start, end in rows:
+        user = columns.get(user_id)
+        if user is None:
+            user = columns[user_id] = (
+                array(DAY_TYPE), array(SECONDS_TYPE), array(SECONDS_TYPE),
+            )
+        user[0].append(day.toordinal())
+        user[1].append(to_seconds(start))
+        user[2].append(to_seconds(end))
+    return columns
+
+
+def copy_rows(target, column, start, stop):
+    """
+    Appends ``column[start:stop]`` to array ``target`` without converting
+    values, column is an ``array`` or a mapped ``ctypes`` array.
+    """
+    if isinstance(column, array):
+        target.extend(column[start:stop])
+    else:
+        size = ctypes.sizeof(column._type_)  # pylint: disable=protected-access
+        target.fromstring(buffer(column, start * size, (stop - start) * size))
+    return target
+
+
+def sort_days(days, starts, ends):
+    """
+    Sorts columns of one user by day, keeping last of repeated days.
+    """
+    if all(days[i] < days[i + 1] for i in xrange(len(days) - 1)):
+        return days, starts, ends
+    rows = dict(zip(days, zip(starts, ends)))
+    ordered = sorted(rows)
+    return (
+        array(DAY_TYPE, ordered),
+        array(SECONDS_TYPE, [rows[day][0] for day in ordered]),
+        array(SECONDS_TYPE, [rows[day][1] for day in ordered]),
+    )
+
+
+def merge_store(store, rows):
+    """
+    Merges parsed rows into given store, ``CsvIngester`` merge function.
+    """
+    if store is None:
+        return PresenceStore.from_rows(rows)
+    return store.merge(rows)
@@ -4,18 +4,45 @@ Presence analyzer unit tests.
 """
 # pylint: disable=maybe-no-member, too-many-public-methods, missing-docstring,
 # pylint: disable=unused-import
+import array
+import BaseHTTPServer
+import bz2
 import calendar
 import datetime
+import gzip
+import hashlib
 import json
 import os.path
+import pstats
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from cStringIO import StringIO
 
-from presence_analyzer import main, utils, views
+from werkzeug.serving import WSGIRequestHandler, make_server
+try:
+    from paste import httpserver
+except ImportError:
+    httpserver = None  # pylint: disable=invalid-name
+
+from presence_analyzer import cache, dataset, fetcher, loader, main, \
+    metrics, shared, snapshot, stats, store, users, utils, views, watcher
+from presence_analyzer.benchmark import generate, load, \
+    suite as benchmark_suite
 
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
+TEST_USERS_XML = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
+)
 
 # pylint: disable=maybe-no-member, too-many-public-methods, missing-docstring,
 
@@ -90,6 +117,24 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             ],
         )
 
+    def test_mean_time_weekday(self):
+        resp = self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                ['Mon', 24123.0],
+                ['Tue', 16564.0],
+                ['Wed', 25321.0],
+                ['Thu', 22984.0],
+                ['Fri', 6426.0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ],
+        )
+        resp = self.client.get('/api/v1/mean_time_weekday/12')
+        self.assertEqual(resp.status_code, 404)
+
     def test_presence_start_end_view(self):
         resp = self.client.get('/api/v1/presence_start_end/10')
         self.assertEqual(resp.status_code, 200)
@@ -107,6 +152,231 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
                 ],
         )
 
+    def test_presence_start_end_view_mean(self):
+        resp = self.client.get('/api/v1/presence_start_end/11')
+        self.assertEqual(resp.status_code, 200)
+        weekdays = utils.group_by_weekday_start_end(utils.get_data()[11])
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                [calendar.day_abbr[day], value[0], value[1]]
+                for day, value in sorted(weekdays.items())
+            ],
+        )
+
+    def test_response_etag(self):
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10', headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11', headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_response_cache(self):
+        self.client.get('/api/v1/mean_time_weekday/10')
+        key = (
+            'response', utils.get_dataset().version,
+            ('presence_analyzer.views', 'mean_time_weekday_view', (),
+             (('user_id', 10),)),
+            (),
+        )
+        self.assertIsNotNone(utils.CACHE.get(key))
+
+    def test_bulk_stats(self):
+        resp = self.client.get(
+            '/api/v1/stats?users=11,12&users=10&metrics=mean,count',
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        data = json.loads(resp.data)
+        self.assertEqual(data['version'], utils.get_dataset().version)
+        self.assertEqual(data['missing'], [12])
+        self.assertItemsEqual(data['users'].keys(), ['10', '11'])
+        self.assertEqual(
+            data['users']['11']['mean'],
+            [24123.0, 16564.0, 25321.0, 22984.0, 6426.0, 0, 0],
+        )
+        self.assertEqual(
+            data['users']['10']['count'], [0, 1, 1, 1, 0, 0, 0],
+        )
+        resp = self.client.get('/api/v1/stats?users=all')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data['users'].keys(), ['10', '11'])
+        self.assertItemsEqual(
+            data['users']['10'].keys(), utils.get_weekday_stats().columns,
+        )
+        for url in ('/api/v1/stats?metrics=mean,bogus',
+                    '/api/v1/stats?users=10,x'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_bulk_stats_gzip(self):
+        plain = self.client.get('/api/v1/stats')
+        resp = self.client.get(
+            '/api/v1/stats', headers={'Accept-Encoding': 'gzip'},
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data,
+        )
+
+    def test_date_window(self):
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11?from=2013-09-06&to=2013-09-12',
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                ['Mon', 24123.0],
+                ['Tue', 16564.0],
+                ['Wed', 25321.0],
+                ['Thu', 22969.0],
+                ['Fri', 0],
+                ['Sat', 0],
+                ['Sun', 0],
+            ],
+        )
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-09-13')
+        self.assertEqual(
+            json.loads(resp.data)[1:6],
+            [['Mon', 0], ['Tue', 0], ['Wed', 0], ['Thu', 0], ['Fri', 6426]],
+        )
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-09-10')
+        self.assertEqual(
+            json.loads(resp.data)[1:3],
+            [
+                [u'Tue', [1, 1, 1, 9, 39, 5], [1, 1, 1, 17, 59, 52]],
+                [u'Wed', [1, 1, 1, 12, 0, 0], [1, 1, 1, 12, 0, 0]],
+            ],
+        )
+        resp = self.client.get(
+            '/api/v1/stats?users=11&metrics=count&from=2013-09-10',
+        )
+        self.assertEqual(
+            json.loads(resp.data)['users']['11']['count'],
+            [0, 1, 1, 1, 1, 0, 0],
+        )
+        for query in ('from=2013-13-01', 'to=yesterday'):
+            resp = self.client.get('/api/v1/mean_time_weekday/11?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_team_weekday(self):
+        data = utils.get_data()
+        weekdays = [[], [], [], [], [], [], []]
+        for items in data.values():
+            for day, values in enumerate(utils.group_by_weekday(items)):
+                weekdays[day].extend(values)
+        resp = self.client.get('/api/v1/team/mean_time_weekday')
+        self.assertEqual(
+            json.loads(resp.data),
+            [
+                [calendar.day_abbr[day], utils.mean(values)]
+                for day, values in enumerate(weekdays)
+            ],
+        )
+        resp = self.client.get('/api/v1/team/presence_weekday')
+        self.assertEqual(
+            json.loads(resp.data)[1:],
+            [
+                [calendar.day_abbr[day], sum(values)]
+                for day, values in enumerate(weekdays)
+            ],
+        )
+        resp = self.client.get('/api/v1/team/weekday')
+        rollup = json.loads(resp.data)
+        self.assertEqual(rollup['users'], [1, 2, 2, 2, 1, 0, 0])
+        self.assertEqual(rollup['count'], [len(i) for i in weekdays])
+        self.assertEqual(rollup['p50'][1], (30047 + 16564) / 2.0)
+        resp = self.client.get('/api/v1/team/weekday?to=2013-09-10')
+        rollup = json.loads(resp.data)
+        self.assertEqual(rollup['users'], [1, 2, 0, 1, 0, 0, 0])
+
+    def test_team_headcount(self):
+        resp = self.client.get('/api/v1/team/headcount')
+        self.assertEqual(resp.status_code, 200)
+        days = json.loads(resp.data)
+        self.assertEqual(len(days), 9)
+        self.assertEqual(days[0], ['2013-09-05', 1, 22999])
+        self.assertEqual(days[1], ['2013-09-06', 0, 0])
+        self.assertEqual([day[1] for day in days[5:]], [2, 2, 2, 1])
+        resp = self.client.get(
+            '/api/v1/team/headcount?from=2013-09-11&to=2014-01-01',
+        )
+        self.assertEqual(
+            [day[0] for day in json.loads(resp.data)],
+            ['2013-09-11', '2013-09-12', '2013-09-13'],
+        )
+
+    def test_team_occupancy(self):
+        resp = self.client.get('/api/v1/team/occupancy?bucket=3600')
+        self.assertEqual(resp.status_code, 200)
+        hours = json.loads(resp.data)
+        self.assertEqual(len(hours), 24)
+        # mean of the nine days of data, weekend and empty ones included
+        self.assertEqual(hours[9], ['09:00', 6, 6 / 9.0])
+        self.assertEqual(hours[13], ['13:00', 9, 1.0])
+        resp = self.client.get(
+            '/api/v1/team/occupancy?weekday=1,2&from=2013-09-11',
+        )
+        quarters = json.loads(resp.data)
+        self.assertEqual(len(quarters), 96)
+        self.assertEqual(quarters[37], ['09:15', 2, 2.0])
+        for query in ('bucket=7', 'bucket=0', 'bucket=x', 'weekday=7'):
+            resp = self.client.get('/api/v1/team/occupancy?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_metrics_view(self):
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/12')
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        self.assertIn(
+            '# TYPE presence_request_duration_seconds histogram', lines,
+        )
+        labels = 'endpoint="mean_time_weekday_view",method="GET",status="404"'
+        self.assertTrue(any(
+            line.startswith('presence_request_duration_seconds_count{%s} '
+                            % labels)
+            for line in lines
+        ))
+        self.assertIn('# TYPE presence_cache_hit_ratio gauge', lines)
+        self.assertTrue(any(
+            line.startswith('presence_cache_requests_total{result="hit"} ')
+            for line in lines
+        ))
+
+    def test_profile_header(self):
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10', headers={'X-Profile': '1'},
+        )
+        self.assertNotIn('X-Profile', resp.headers)
+        tmpdir = tempfile.mkdtemp()
+        main.app.config.update({'PROFILING': True, 'PROFILE_DIR': tmpdir})
+        try:
+            resp = self.client.get(
+                '/api/v1/presence_weekday/10', headers={'X-Profile': '1'},
+            )
+            self.assertEqual(resp.status_code, 200)
+            path = resp.headers['X-Profile']
+            self.assertEqual(os.path.dirname(path), tmpdir)
+            self.assertGreater(pstats.Stats(path).total_calls, 0)
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertNotIn('X-Profile', resp.headers)
+        finally:
+            del main.app.config['PROFILING']
+            del main.app.config['PROFILE_DIR']
+            shutil.rmtree(tmpdir)
+
     def test_user_view(self):
         resp = self.client.get('/api/v1/user/10')
         self.assertEqual(resp.status_code, 200)
@@ -167,6 +437,27 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
                 }
         )
 
+    def test_group_by_weekday_start_end_mean(self):
+        data = utils.get_data()
+        result = utils.group_by_weekday_start_end(data[11])
+        # true mean of 09:28:08/10:18:36 and 15:51:27/16:41:25
+        self.assertEqual(
+            result[3], [[1, 1, 1, 9, 53, 22], [1, 1, 1, 16, 16, 26]],
+        )
+
+    def test_start_end_entry(self):
+        self.assertEqual(utils.start_end_entry(None), [1, 1, 1, 12, 0, 0])
+        self.assertEqual(utils.start_end_entry(0), [1, 1, 1, 0, 0, 0])
+        self.assertEqual(
+            utils.start_end_entry(86398.6), [1, 1, 1, 23, 59, 59],
+        )
+
+    def test_get_dataset(self):
+        current = utils.get_dataset()
+        self.assertIs(utils.get_store(), current.store)
+        self.assertIs(utils.get_weekday_stats(), current.weekday_stats)
+        self.assertItemsEqual(current.store.users, [10, 11])
+
     def test_group_by_weekday(self):
         data = utils.get_data()
         weekdays = data[10]
@@ -316,16 +607,1673 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         )
         self.assertEquals(
             utils.user(11, path),
-            {"image_url": "http://www.designofsignage.com/application/symbol/"
-                          "building/image/600x600/no-photo.jpg",
+            {"image_url": "/static/img/no-photo.png",
              "name": "Anonymous user"}
         )
         self.assertEquals(
             utils.user(999, path),
-            {"image_url": "http://www.designofsignage.com/application/symbol/"
-                          "building/image/600x600/no-photo.jpg",
+            {"image_url": "/static/img/no-photo.png",
              "name": "Anonymous user"}
         )
+        self.assertEquals(utils.user(999, path, name=False),
+                          {"image_url": "/static/img/no-photo.png"})
+        self.assertEquals(utils.user(999, path, image_url=False),
+                          "Anonymous user")
+        resp = main.app.test_client().get(utils.default_avatar())
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Cache tests.
+    """
+
+    def test_make_key(self):
+        self.assertEqual(
+            cache.make_key(utils.mean, (1, 2), {'b': 2, 'a': 1}),
+            ('presence_analyzer.utils', 'mean', (1, 2),
+             (('a', 1), ('b', 2))),
+        )
+        self.assertEqual(
+            hash(cache.make_key(utils.mean, (1,), {})),
+            hash(cache.make_key(utils.mean, (1,), {})),
+        )
+
+    def test_lru_eviction(self):
+        lru = cache.Cache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(
+            lru.stats(),
+            {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1,
+             'evictions': 1},
+        )
+
+    def test_ttl(self):
+        lru = cache.Cache()
+        lru.set('a', 1, ttl=-1)
+        lru.set('b', 2, ttl=60)
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
+        self.assertEqual(lru.get('b'), 2)
+
+    def test_invalidate(self):
+        lru = cache.Cache()
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.invalidate('a')
+        lru.invalidate('x')
+        self.assertIsNone(lru.get('a'))
+        lru.clear()
+        self.assertIsNone(lru.get('b'))
+
+    def test_cached(self):
+        calls = []
+        lru = cache.Cache()
+
+        @utils.cached(60, lru)
+        def double(value):
+            calls.append(value)
+            return value * 2
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(3), 6)
+        self.assertEqual(calls, [2, 3])
+        double.invalidate(2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2, 3, 2])
+        self.assertEqual(len(lru), 2)
+
+
+class PresenceAnalyzerCachedTestCase(unittest.TestCase):
+    """
+    Locking of cached decorator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.calls = []
+        self.release = threading.Event()
+
+    def slow(self, value):
+        self.calls.append(value)
+        if value == 2:
+            self.release.wait(5)
+        return value * 2
+
+    def test_single_flight(self):
+        slow = utils.cached(60, cache.Cache())(self.slow)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slow(2)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [4] * 5)
+        self.assertEqual(self.calls, [2])
+
+    def test_other_keys_not_blocked(self):
+        slow = utils.cached(60, cache.Cache())(self.slow)
+        thread = threading.Thread(target=slow, args=(2,))
+        thread.start()
+        time.sleep(0.1)
+        # key 2 is being computed, key 3 does not wait for it
+        self.assertEqual(slow(3), 6)
+        self.assertFalse(self.release.is_set())
+        self.release.set()
+        thread.join()
+        self.assertEqual(self.calls, [2, 3])
+
+    def test_stale_while_revalidate(self):
+        values = iter([1, 2])
+        self.release.set()
+
+        @utils.cached(-1, cache.Cache(), stale=True)
+        def counter():
+            self.calls.append(None)
+            return next(values)
+
+        self.assertEqual(counter(), 1)
+        # expired value is returned while it is computed again
+        self.assertEqual(counter(), 1)
+        for _ in range(50):
+            if len(self.calls) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_stale_refresh_error(self):
+        @utils.cached(-1, cache.Cache(), stale=True)
+        def failing():
+            self.calls.append(None)
+            if len(self.calls) > 1:
+                raise ValueError()
+            return 1
+
+        self.assertEqual(failing(), 1)
+        self.assertEqual(failing(), 1)
+        time.sleep(0.1)
+        self.assertEqual(failing(), 1)
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    CSV ingestion tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.lines = csvfile.read().splitlines(True)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, lines, mode='w'):
+        with open(self.path, mode) as csvfile:
+            csvfile.write(''.join(lines))
+
+    def test_parse_rows(self):
+        rows = list(loader.parse_rows([
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\n',
+            '10,2013-13-10,09:39:05,17:59:52\n',
+            '10,2013-09-11,25:39:05,17:59:52\n',
+            'x,2013-09-11,09:39:05,17:59:52\n',
+        ]))
+        self.assertEqual(rows, [(
+            10,
+            datetime.date(2013, 9, 10),
+            datetime.time(9, 39, 5),
+            datetime.time(17, 59, 52),
+        )])
+
+    def test_parse_row(self):
+        rows = [
+            ['10', '2013-09-10', '09:39:05', '17:59:52'],
+            ['10', '2013-9-1', '9:39:05', '17:59:52'],
+            ['10', '2013-09-10', '09:39:5', '7:59:52'],
+        ]
+        for row in rows:
+            self.assertEqual(
+                loader.parse_row(row), loader.parse_row_strptime(row),
+            )
+        bad_rows = [
+            ['10', '2013-02-30', '09:39:05', '17:59:52'],
+            ['10', '2013-09-10', '24:39:05', '17:59:52'],
+            ['10', '2013-+9-10', '09:39:05', '17:59:52'],
+            ['10', '2013-09-10', '09:39:05', '17:59: 2'],
+            ['10', '2013/09/10', '09:39:05', '17:59:52'],
+            ['1 0', '2013-09-10', '09:39:05', '17:59:52'],
+        ]
+        for row in bad_rows:
+            self.assertRaises(ValueError, loader.parse_row, row)
+            self.assertRaises(ValueError, loader.parse_row_strptime, row)
+
+    def test_split_rows(self):
+        self.assertEqual(
+            list(loader.split_rows([
+                '10,2013-09-10,09:39:05,17:59:52\r\n',
+                '"10","2013-09-10","09:39:05","17:59:52"\n',
+                '\n',
+            ])),
+            [
+                ['10', '2013-09-10', '09:39:05', '17:59:52'],
+                ['10', '2013-09-10', '09:39:05', '17:59:52'],
+                [''],
+            ],
+        )
+
+    def test_read_data(self):
+        data = loader.read_data(TEST_DATA_CSV)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(len(data[11]), 6)
+
+    def write_gzip(self, lines, path):
+        with gzip.open(path, 'wb') as gzfile:
+            gzfile.write(''.join(lines))
+
+    def test_read_compressed(self):
+        expected = loader.read_data(TEST_DATA_CSV)
+        content = ''.join(self.lines)
+        self.write_gzip(self.lines, self.path + '.gz')
+        with open(self.path + '.bz2', 'wb') as bz2file:
+            bz2file.write(bz2.compress(content))
+        for path in (self.path + '.gz', self.path + '.bz2'):
+            self.assertEqual(loader.read_data(path), expected)
+            self.assertEqual(len(list(loader.iter_rows(path))), 9)
+
+    def test_read_concatenated_streams(self):
+        expected = loader.read_data(TEST_DATA_CSV)
+        first = bz2.compress(''.join(self.lines[:4]))
+        second = bz2.compress(''.join(self.lines[4:]))
+        with open(self.path + '.bz2', 'wb') as bz2file:
+            bz2file.write(first + second)
+        self.write_gzip(self.lines[:4], self.path + '.gz')
+        with gzip.open(self.path + '.gz', 'ab') as gzfile:
+            gzfile.write(''.join(self.lines[4:]))
+        block_size = loader.BLOCK_SIZE
+        try:
+            # first stream ends right at the end of a block, or not
+            for loader.BLOCK_SIZE in (len(first), 7, block_size):
+                self.assertEqual(loader.read_data(self.path + '.bz2'),
+                                 expected)
+                self.assertEqual(loader.read_data(self.path + '.gz'),
+                                 expected)
+        finally:
+            loader.BLOCK_SIZE = block_size
+
+    @unittest.skipIf(loader.lzma is None, 'backports.lzma is not installed')
+    def test_read_xz(self):
+        with open(self.path + '.xz', 'wb') as xzfile:
+            xzfile.write(loader.lzma.compress(''.join(self.lines)))
+        self.assertEqual(
+            loader.read_data(self.path + '.xz'),
+            loader.read_data(TEST_DATA_CSV),
+        )
+
+    def test_ingester_compressed(self):
+        path = self.path + '.gz'
+        self.write_gzip(self.lines[:4], path)
+        snapshot_path = os.path.join(self.tmpdir, 'data.snapshot')
+        ingester = loader.CsvIngester(
+            path, dataset.merge_dataset,
+            snapshot.DatasetSnapshot(snapshot_path),
+        )
+        first = ingester.update()
+        self.assertEqual(len(first.store[11]), 1)
+        self.assertIs(ingester.update(), first)
+        self.assertTrue(os.path.exists(snapshot_path))
+        self.write_gzip(self.lines, path)
+        updated = ingester.update()
+        self.assertEqual(dict(updated.store), loader.read_data(TEST_DATA_CSV))
+        restored = loader.CsvIngester(
+            path, dataset.merge_dataset,
+            snapshot.DatasetSnapshot(snapshot_path),
+        ).update()
+        self.assertNotIsInstance(restored.store.days, array.array)
+        self.assertEqual(dict(restored.store), dict(updated.store))
+        # snapshot of first member is not continued in compressed bytes
+        self.write_gzip(self.lines[:4], path)
+        loader.CsvIngester(
+            path, dataset.merge_dataset,
+            snapshot.DatasetSnapshot(snapshot_path),
+        ).update()
+        with gzip.open(path, 'ab') as gzfile:
+            gzfile.write(''.join(self.lines[4:]))
+        appended = loader.CsvIngester(
+            path, dataset.merge_dataset,
+            snapshot.DatasetSnapshot(snapshot_path),
+        ).update()
+        self.assertEqual(
+            dict(appended.store), loader.read_data(TEST_DATA_CSV),
+        )
+
+    def test_ingester_append(self):
+        self.write(self.lines[:4])
+        ingester = loader.CsvIngester(self.path)
+        data = ingester.update()
+        self.assertEqual(len(data[10]), 3)
+        self.assertEqual(len(data[11]), 1)
+        offset = ingester.offset
+        self.assertIs(ingester.update(), data)
+        self.write(self.lines[4:], 'a')
+        merged = ingester.update()
+        self.assertGreater(ingester.offset, offset)
+        self.assertEqual(merged, loader.read_data(TEST_DATA_CSV))
+        # earlier result is not modified
+        self.assertEqual(len(data[11]), 1)
+
+    def test_ingester_partial_line(self):
+        self.write(self.lines[:2] + ['11,2013-09-05,09:28:08,15:5'])
+        ingester = loader.CsvIngester(self.path)
+        ingester.update()
+        self.write(['1:27\n'], 'a')
+        data = ingester.update()
+        self.assertEqual(
+            data[11][datetime.date(2013, 9, 5)]['end'],
+            datetime.time(15, 51, 27),
+        )
+
+    def test_ingester_truncate(self):
+        self.write(self.lines)
+        ingester = loader.CsvIngester(self.path)
+        ingester.update()
+        self.write(self.lines[3:])
+        data = ingester.update()
+        self.assertItemsEqual(data.keys(), [11])
+        # same size, different content
+        self.write([line.replace('09:', '08:') for line in self.lines[3:]])
+        data = ingester.update()
+        self.assertEqual(
+            data[11][datetime.date(2013, 9, 5)]['start'],
+            datetime.time(8, 28, 8),
+        )
+
+    def test_ingester_dataset(self):
+        self.write(self.lines[:4])
+        ingester = loader.CsvIngester(self.path, dataset.merge_dataset)
+        first = ingester.update()
+        self.assertEqual(first.weekday_stats.get(11, 'count')[3], 1)
+        self.assertIs(dataset.merge_dataset(first, []), first)
+        self.write(self.lines[4:], 'a')
+        updated = ingester.update()
+        self.assertIsNot(updated, first)
+        self.assertEqual(updated.weekday_stats.get(11, 'count')[3], 2)
+        self.assertEqual(first.weekday_stats.get(11, 'count')[3], 1)
+
+    def assertSameDataset(self, first, second):  # pylint: disable=C0103
+        for name in snapshot.STORE_COLUMNS:
+            self.assertEqual(
+                list(getattr(first.store, name)),
+                list(getattr(second.store, name)),
+            )
+        self.assertItemsEqual(
+            first.weekday_stats.columns, second.weekday_stats.columns,
+        )
+        for name, column in first.weekday_stats.columns.items():
+            self.assertEqual(
+                list(column), list(second.weekday_stats.columns[name]),
+            )
+        self.assertEqual(first.team_stats.weekdays,
+                         second.team_stats.weekdays)
+        self.assertEqual(first.team_stats.days(), second.team_stats.days())
+
+    def test_merge_dataset_incremental(self):
+        generate.generate_csv(self.path, 30, 60, seed=2)
+        with open(self.path) as csvfile:
+            rows = list(loader.parse_rows(csvfile))
+        earlier, later = rows[:len(rows) // 2], rows[len(rows) // 2:]
+        added = [
+            # repeated day, new user and day before all the others
+            (later[0][0], later[0][1], datetime.time(7, 0, 0),
+             datetime.time(8, 0, 0)),
+            (999, later[0][1], datetime.time(9, 0, 0),
+             datetime.time(10, 0, 0)),
+            (earlier[0][0], earlier[0][1] - datetime.timedelta(days=30),
+             datetime.time(9, 0, 0), datetime.time(17, 0, 0)),
+        ]
+        full = dataset.make_dataset(
+            store.PresenceStore.from_rows(earlier + later + added),
+        )
+        merged = dataset.merge_dataset(None, earlier)
+        merged = dataset.merge_dataset(merged, later)
+        merged = dataset.merge_dataset(merged, added)
+        self.assertSameDataset(merged, full)
+        # summaries of users without new rows are copied
+        snapshot_path = os.path.join(self.tmpdir, 'data.snapshot')
+        snapshot.write_columns(
+            snapshot_path, snapshot.NO_SOURCE,
+            snapshot.dataset_columns(dataset.merge_dataset(None, earlier)),
+        )
+        mapped = snapshot.read_dataset(snapshot_path)
+        merged = dataset.merge_dataset(mapped, later + added)
+        self.assertSameDataset(merged, full)
+
+    def test_get_ingester(self):
+        self.assertIs(
+            loader.get_ingester(self.path), loader.get_ingester(self.path),
+        )
+
+    def test_chunk_ranges(self):
+        self.write(self.lines)
+        size = os.path.getsize(self.path)
+        for count in (1, 2, 5, 50):
+            ranges = loader.chunk_ranges(self.path, size, count)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], size)
+            with open(self.path, 'rb') as csvfile:
+                content = csvfile.read()
+            for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(stop, start)
+                self.assertEqual(content[start - 1], '\n')
+
+    def test_ingester_parallel(self):
+        self.write(self.lines + [
+            '\r\n10,2013-13-10,09:39:05,17:59:52\r\n',
+            '11,2013-09-05,10:00:00,15:00:00\r\n',
+            'x,2013-09-11,09:39:05,17:59:52\r\n',
+            '10,2013-09-20,09:00:00,1',
+        ])
+        serial = loader.CsvIngester(self.path, dataset.merge_dataset)
+        parallel = loader.CsvIngester(
+            self.path, dataset.merge_dataset, workers=2,
+            from_columns=dataset.dataset_from_user_columns,
+        )
+        expected = serial.update().store
+        data = parallel.update().store
+        self.assertEqual(dict(data.items()), dict(expected.items()))
+        self.assertEqual(
+            data[11][datetime.date(2013, 9, 5)]['start'],
+            datetime.time(10, 0, 0),
+        )
+        self.assertEqual(
+            (parallel.offset, parallel.lines, parallel.tail),
+            (serial.offset, serial.lines, serial.tail),
+        )
+        self.write(['0:00\n'], 'a')
+        self.assertEqual(
+            dict(parallel.update().store.items()),
+            dict(serial.update().store.items()),
+        )
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.snapshot_path = self.path + '.snapshot'
+        with open(TEST_DATA_CSV) as csvfile:
+            self.lines = csvfile.read().splitlines(True)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write(''.join(self.lines[:4]))
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def ingester(self):
+        return loader.CsvIngester(
+            self.path, dataset.merge_dataset,
+            snapshot.DatasetSnapshot(self.snapshot_path),
+        )
+
+    def test_columns(self):
+        columns = [
+            ('ints', array.array('i', [1, -2, 3])),
+            ('longs', array.array('l', [2 ** 40])),
+            ('floats', array.array('d', [0.5, 1.5])),
+            ('empty', array.array('i')),
+        ]
+        key = (10, 1.5, 'x' * 20, 8, 2)
+        snapshot.write_columns(self.snapshot_path, key, columns)
+        read_key, read = snapshot.read_columns(self.snapshot_path)
+        self.assertEqual(read_key, key)
+        for name, column in columns:
+            self.assertEqual(list(read[name]), list(column))
+
+    def test_read_invalid(self):
+        self.assertIsNone(snapshot.read_columns(self.snapshot_path))
+        with open(self.snapshot_path, 'w') as snapshot_file:
+            snapshot_file.write('not a snapshot' * 10)
+        self.assertIsNone(snapshot.read_columns(self.snapshot_path))
+
+    def test_save_and_load(self):
+        parsed = self.ingester().update()
+        self.assertTrue(os.path.exists(self.snapshot_path))
+        ingester = self.ingester()
+        loaded = ingester.update()
+        self.assertNotIsInstance(loaded.store.days, array.array)
+        self.assertEqual(dict(loaded.store), dict(parsed.store))
+        self.assertEqual(
+            loaded.weekday_stats.user(11), parsed.weekday_stats.user(11),
+        )
+        # team rollup is read from the snapshot, not rolled up again
+        self.assertNotIsInstance(loaded.team_stats.headcount, array.array)
+        self.assertEqual(
+            loaded.team_stats.weekdays, parsed.team_stats.weekdays,
+        )
+        self.assertEqual(loaded.team_stats.days(), parsed.team_stats.days())
+        self.assertEqual(ingester.offset, os.path.getsize(self.path))
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:]))
+        self.assertEqual(
+            dict(ingester.update().store), loader.read_data(TEST_DATA_CSV),
+        )
+
+    def test_empty_team_columns(self):
+        empty = dataset.merge_dataset(None, ())
+        snapshot.write_columns(
+            self.snapshot_path, snapshot.NO_SOURCE,
+            snapshot.dataset_columns(empty),
+        )
+        loaded = snapshot.read_dataset(self.snapshot_path)
+        self.assertIsNone(loaded.team_stats.first_day)
+        self.assertEqual(loaded.team_stats.days(), [])
+        self.assertEqual(loaded.team_stats.weekdays, empty.team_stats.weekdays)
+
+    def test_load_appended(self):
+        self.ingester().update()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:]))
+        with open(self.path, 'rb') as csvfile:
+            restored = snapshot.DatasetSnapshot(self.snapshot_path).load(
+                csvfile, os.fstat(csvfile.fileno()),
+            )
+        self.assertEqual(restored[1], size)
+        self.assertEqual(len(restored[0].store.days), 4)
+        ingester = self.ingester()
+        self.assertEqual(
+            dict(ingester.update().store), loader.read_data(TEST_DATA_CSV),
+        )
+        # appended rows were saved in a new snapshot
+        key, _ = snapshot.read_columns(self.snapshot_path)
+        self.assertEqual(key[0], os.path.getsize(self.path))
+
+    def test_save_after_append(self):
+        ingester = self.ingester()
+        ingester.update()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:6]))
+        ingester.update()
+        self.assertEqual(snapshot.read_columns(self.snapshot_path)[0][0], size)
+        ingester.saved -= loader.SNAPSHOT_INTERVAL
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[6:]))
+        ingester.update()
+        key, _ = snapshot.read_columns(self.snapshot_path)
+        self.assertEqual(key[0], os.path.getsize(self.path))
+        self.assertEqual(
+            dict(self.ingester().update().store),
+            loader.read_data(TEST_DATA_CSV),
+        )
+
+    def test_export_columns(self):
+        with gzip.open(self.path + '.gz', 'wb') as gzfile:
+            gzfile.write(''.join(self.lines))
+        target = snapshot.export_columns(self.path + '.gz')
+        self.assertEqual(target, os.path.join(self.tmpdir, 'data.columns'))
+        self.assertTrue(snapshot.is_columnar(target))
+        self.assertFalse(snapshot.is_columnar(self.path))
+        ingester = snapshot.ColumnarIngester(target)
+        exported = ingester.update()
+        self.assertNotIsInstance(exported.store.days, array.array)
+        self.assertEqual(
+            dict(exported.store), loader.read_data(TEST_DATA_CSV),
+        )
+        self.assertEqual(
+            exported.weekday_stats.user(11),
+            loader.read_data(TEST_DATA_CSV, dataset.merge_dataset)
+            .weekday_stats.user(11),
+        )
+        self.assertIs(ingester.update(), exported)
+        snapshot.export_columns(self.path, target)
+        self.assertEqual(list(ingester.update().store.users), [10, 11])
+        self.assertEqual(len(ingester.update().store[11]), 1)
+
+    def test_read_dataset_invalid(self):
+        with self.assertRaises(IOError):
+            snapshot.read_dataset(os.path.join(self.tmpdir, 'x.columns'))
+        with self.assertRaises(IOError):
+            snapshot.read_dataset(self.path)
+
+    def test_columnar_data_csv(self):
+        target = snapshot.export_columns(TEST_DATA_CSV, os.path.join(
+            self.tmpdir, 'data.columns',
+        ))
+        saved = main.app.config.get('DATA_CSV')
+        main.app.config.update({'DATA_CSV': target})
+        utils.CACHE.clear()
+        try:
+            self.assertEqual(
+                dict(utils.get_data()), loader.read_data(TEST_DATA_CSV),
+            )
+            client = main.app.test_client()
+            resp = client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data)[2], ['Tue', 30047])
+        finally:
+            main.app.config.update({'DATA_CSV': saved})
+            utils.CACHE.clear()
+
+    def test_outdated(self):
+        self.ingester().update()
+        with open(self.path, 'w') as csvfile:
+            csvfile.write(''.join(self.lines[:3]))
+        data = self.ingester().update()
+        self.assertEqual(list(data.store.users), [10])
+
+
+class PresenceAnalyzerWatcherTestCase(unittest.TestCase):
+    """
+    Background data watcher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.lines = csvfile.read().splitlines(True)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write(''.join(self.lines[:4]))
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        watcher.stop_watcher(self.path)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        shutil.rmtree(self.tmpdir)
+
+    def test_reload(self):
+        data_watcher = watcher.DataWatcher(self.path)
+        self.assertTrue(data_watcher.reload())
+        first = data_watcher.dataset
+        self.assertFalse(data_watcher.reload())
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:]))
+        self.assertTrue(data_watcher.reload())
+        self.assertGreater(data_watcher.dataset.version, first.version)
+        self.assertEqual(len(data_watcher.dataset.store.days), 9)
+
+    def test_background_reload(self):
+        data_watcher = watcher.start_watcher(self.path, 0.01)
+        self.assertIs(watcher.start_watcher(self.path), data_watcher)
+        main.app.config.update({'DATA_CSV': self.path})
+        first = utils.get_dataset()
+        self.assertIs(first, data_watcher.dataset)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:]))
+        for _ in range(100):
+            if utils.get_dataset() is not first:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(utils.get_dataset().store.days), 9)
+        client = main.app.test_client()
+        resp = client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(
+            resp.headers['X-Data-Version'],
+            str(utils.get_dataset().version),
+        )
+        watcher.stop_watcher(self.path)
+        self.assertIsNone(watcher.get_watcher(self.path))
+
+    def test_forked_process(self):
+        parent = watcher.start_watcher(self.path, 0.01)
+
+        def check():
+            data_watcher = watcher.get_watcher(self.path)
+            with open(self.path, 'a') as csvfile:
+                csvfile.write(''.join(self.lines[4:]))
+            for _ in range(100):
+                if len(data_watcher.dataset.store.days) == 9:
+                    break
+                time.sleep(0.01)
+            return data_watcher is not parent and \
+                data_watcher.pid == os.getpid() and \
+                watcher.get_watcher(self.path) is data_watcher and \
+                len(data_watcher.dataset.store.days) == 9
+
+        self.assertTrue(run_forked(check))
+        self.assertIs(watcher.get_watcher(self.path), parent)
+
+
+def run_forked(function):
+    """
+    Calls function in a forked process, returns if it returned true.
+    """
+    exit_now = os._exit  # pylint: disable=protected-access
+    pid = os.fork()
+    if not pid:
+        try:
+            exit_now(0 if function() else 1)
+        except BaseException:  # pylint: disable=broad-except
+            exit_now(2)
+    return os.waitpid(pid, 0)[1] == 0
+
+
+class PresenceAnalyzerSharedTestCase(unittest.TestCase):
+    """
+    Shared memory-mapped dataset tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.directory = os.path.join(self.tmpdir, 'shared')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.lines = csvfile.read().splitlines(True)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write(''.join(self.lines[:4]))
+        self.watchers = []
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for data_watcher in self.watchers:
+            data_watcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def watcher(self, directory=None, snapshot_path=None):
+        data_watcher = shared.SharedDataWatcher(
+            self.path, directory or self.directory, 60,
+            snapshot_path and snapshot.DatasetSnapshot(snapshot_path),
+        )
+        self.watchers.append(data_watcher)
+        return data_watcher
+
+    def test_publish_and_attach(self):
+        publisher, worker = self.watcher(), self.watcher()
+        self.assertIsNone(worker.dataset)
+        self.assertTrue(publisher.reload())
+        self.assertTrue(publisher.is_publisher())
+        self.assertFalse(worker.is_publisher())
+        self.assertTrue(worker.reload())
+        self.assertEqual(worker.dataset.version, publisher.dataset.version)
+        self.assertNotIsInstance(worker.dataset.store.days, array.array)
+        self.assertEqual(
+            worker.dataset.weekday_stats.user(11),
+            publisher.ingester.data.weekday_stats.user(11),
+        )
+        self.assertEqual(
+            dict(worker.dataset.store), loader.read_data(self.path),
+        )
+        self.assertFalse(worker.reload())
+
+    def test_new_generation(self):
+        publisher, worker = self.watcher(), self.watcher()
+        publisher.reload()
+        worker.reload()
+        first = worker.generation
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(''.join(self.lines[4:]))
+        publisher.reload()
+        self.assertTrue(worker.reload())
+        self.assertGreater(worker.generation, first)
+        self.assertEqual(
+            os.listdir(self.directory).count('segment.%d' % first), 0,
+        )
+        self.assertEqual(len(worker.dataset.store.days), 9)
+
+    def test_publisher_takeover(self):
+        publisher, worker = self.watcher(), self.watcher()
+        publisher.reload()
+        publisher.stop()
+        self.assertTrue(worker.is_publisher())
+        self.assertTrue(worker.reload())
+        self.assertEqual(worker.current_generation(), worker.published)
+        self.assertNotEqual(worker.published, publisher.published)
+        self.assertEqual(len(worker.dataset.store.days), 4)
+
+    def test_forked_worker(self):
+        parent = watcher.start_watcher(
+            self.path, 60, factory=shared.SharedDataWatcher,
+            directory=self.directory,
+        )
+        self.assertTrue(parent.is_publisher())
+
+        def check():
+            worker = watcher.get_watcher(self.path)
+            # the lock inherited from the parent is not taken as own
+            return worker is not parent and not worker.is_publisher() \
+                and worker.generation == parent.generation
+
+        try:
+            self.assertTrue(run_forked(check))
+            self.assertIsNotNone(parent.lock_file)
+        finally:
+            watcher.stop_watcher(self.path)
+
+    def test_publish_from_snapshot(self):
+        snapshot_path = self.path + '.snapshot'
+        first = self.watcher(snapshot_path=snapshot_path)
+        first.reload()
+        # restarted with data mapped from the snapshot
+        second = self.watcher(
+            os.path.join(self.tmpdir, 'other'), snapshot_path,
+        )
+        self.assertTrue(second.reload())
+        self.assertNotIsInstance(
+            second.ingester.data.store.days, array.array,
+        )
+        self.assertEqual(
+            dict(second.dataset.store), dict(first.dataset.store),
+        )
+        self.assertEqual(
+            second.dataset.weekday_stats.user(11),
+            first.dataset.weekday_stats.user(11),
+        )
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        with open(TEST_DATA_CSV) as csvfile:
+            self.rows = list(loader.parse_rows(csvfile))
+
+    def test_from_rows(self):
+        presence = store.PresenceStore.from_rows(self.rows)
+        self.assertEqual(list(presence.users), [10, 11])
+        self.assertEqual(list(presence.offsets), [0, 3, 9])
+        self.assertEqual(presence.nbytes(), 2 * 4 + 3 * 8 + 3 * 9 * 4)
+        self.assertEqual(presence.rows(11), (3, 9))
+        self.assertEqual(presence.rows(12), (0, 0))
+        self.assertEqual(dict(presence), loader.read_data(TEST_DATA_CSV))
+
+    def test_from_rows_unsorted(self):
+        rows = list(reversed(self.rows))
+        repeated = (10, datetime.date(2013, 9, 11),
+                    datetime.time(8, 0, 0), datetime.time(9, 0, 0))
+        presence = store.PresenceStore.from_rows(rows + [repeated])
+        expected = loader.merge_rows(None, rows + [repeated])
+        self.assertEqual(dict(presence), expected)
+        self.assertEqual(list(presence.days), sorted(presence.days[:3]) +
+                         sorted(presence.days[3:]))
+
+    def test_mapping(self):
+        presence = store.PresenceStore.from_rows(self.rows)
+        self.assertIn(10, presence)
+        self.assertNotIn(12, presence)
+        self.assertEqual(presence.keys(), [10, 11])
+        self.assertEqual(len(presence), 2)
+        self.assertEqual(
+            presence[10][datetime.date(2013, 9, 10)],
+            {'start': datetime.time(9, 39, 5),
+             'end': datetime.time(17, 59, 52)},
+        )
+        with self.assertRaises(KeyError):
+            presence[12]  # pylint: disable=pointless-statement
+
+    def test_merge(self):
+        presence = store.merge_store(None, self.rows[:4])
+        added = [(12, datetime.date(2013, 9, 1),
+                  datetime.time(8, 0, 0), datetime.time(9, 0, 0))]
+        merged = store.merge_store(presence, self.rows[4:] + added)
+        self.assertEqual(
+            dict(merged), loader.merge_rows(None, self.rows + added),
+        )
+        self.assertEqual(len(presence.days), 4)
+        self.assertIs(presence.merge([]), presence)
+
+    def test_get_data_columnar(self):
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV, 'DATA_STORE': 'columnar',
+        })
+        utils.get_data.invalidate()
+        try:
+            data = utils.get_data()
+        finally:
+            del main.app.config['DATA_STORE']
+            utils.get_data.invalidate()
+        self.assertIsInstance(data, store.PresenceStore)
+        self.assertEqual(
+            utils.group_by_weekday(data[11]),
+            utils.group_by_weekday(loader.read_data(TEST_DATA_CSV)[11]),
+        )
+
+
+class PresenceAnalyzerStatsTestCase(unittest.TestCase):
+    """
+    Weekday statistics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data = loader.read_data(TEST_DATA_CSV)
+        self.stats = stats.WeekdayStats.from_store(
+            store.PresenceStore.from_rows(
+                (user_id, day, value['start'], value['end'])
+                for user_id, days in self.data.items()
+                for day, value in days.items()
+            ),
+            percentiles=(0, 50, 100),
+        )
+
+    def test_weekday(self):
+        for day in range(1, 15):
+            sample = datetime.date(2013, 9, day)
+            self.assertEqual(
+                stats.weekday(sample.toordinal()), sample.weekday(),
+            )
+
+    def test_percentile(self):
+        self.assertEqual(stats.percentile([], 50), 0)
+        self.assertEqual(stats.percentile([5], 90), 5)
+        self.assertEqual(stats.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(stats.percentile([1, 2, 3, 4], 100), 4)
+
+    def test_from_store(self):
+        for user_id in (10, 11):
+            weekdays = utils.group_by_weekday(self.data[user_id])
+            self.assertEqual(
+                self.stats.get(user_id, 'count'), [len(i) for i in weekdays],
+            )
+            self.assertEqual(
+                self.stats.get(user_id, 'total'), [sum(i) for i in weekdays],
+            )
+            self.assertEqual(
+                self.stats.get(user_id, 'mean'),
+                [utils.mean(i) for i in weekdays],
+            )
+            self.assertEqual(
+                self.stats.get(user_id, 'min'),
+                [min(i) if i else 0 for i in weekdays],
+            )
+            self.assertEqual(
+                self.stats.get(user_id, 'p100'),
+                [max(i) if i else 0 for i in weekdays],
+            )
+        self.assertEqual(self.stats.get(11, 'p50')[3], 22984.0)
+
+    def test_user(self):
+        self.assertIn(10, self.stats)
+        self.assertNotIn(12, self.stats)
+        result = self.stats.user(10)
+        self.assertItemsEqual(
+            result.keys(),
+            ['count', 'total', 'min', 'max', 'mean', 'p0', 'p50', 'p100',
+             'start_total', 'end_total', 'start_mean', 'end_mean'],
+        )
+        self.assertEqual(result['max'], [0, 30047, 24465, 23705, 0, 0, 0])
+
+    def test_index_window(self):
+        presence = store.PresenceStore.from_rows(
+            loader.iter_rows(TEST_DATA_CSV),
+        )
+        index = stats.WeekdayIndex.from_store(presence)
+        self.assertIn(11, index)
+        for user_id in (10, 11):
+            self.assertEqual(
+                index.window(user_id, names=self.stats.columns),
+                self.stats.user(user_id),
+            )
+        first = datetime.date(2013, 9, 6).toordinal()
+        last = datetime.date(2013, 9, 12).toordinal()
+        expected = stats.WeekdayStats.from_store(
+            store.PresenceStore.from_rows(
+                row for row in loader.iter_rows(TEST_DATA_CSV)
+                if first <= row[1].toordinal() <= last
+            ),
+            percentiles=(50,),
+        )
+        for user_id in (10, 11):
+            self.assertEqual(
+                index.window(user_id, first, last, expected.columns),
+                expected.user(user_id),
+            )
+            sums = index.window(user_id, first, last)
+            self.assertItemsEqual(sums.keys(), stats.SUM_COLUMNS)
+            for name in stats.SUM_COLUMNS:
+                self.assertEqual(sums[name], expected.get(user_id, name))
+        self.assertEqual(index.window(11, last + 1)['count'],
+                         [0, 0, 0, 0, 1, 0, 0])
+        self.assertEqual(index.window(11, last, first)['total'], [0] * 7)
+
+    def test_index_window_sums_only(self):
+        presence = store.PresenceStore.from_rows(
+            loader.iter_rows(TEST_DATA_CSV),
+        )
+        index = stats.WeekdayIndex.from_store(presence)
+        sorts = []
+        # counts sorting of presence times in the module
+        stats.sorted = lambda values: sorts.append(1) or sorted(values)
+        try:
+            index.window(11, names=('mean', 'total'))
+            self.assertEqual(sorts, [])
+            index.window(11, names=('p50',))
+            self.assertNotEqual(sorts, [])
+        finally:
+            del stats.sorted
+
+    def test_occupancy(self):
+        presence = store.PresenceStore.from_rows(
+            loader.iter_rows(TEST_DATA_CSV),
+        )
+        rows = list(loader.iter_rows(TEST_DATA_CSV))
+        first_day = min(row[1] for row in rows)
+        calendar_days = [
+            first_day + datetime.timedelta(days=i)
+            for i in range((max(row[1] for row in rows) - first_day).days + 1)
+        ]
+        for bucket, weekdays in ((60, None), (900, set([1, 2])),
+                                 (3600, set([5]))):
+            counts, days = stats.occupancy(presence, bucket, weekdays)
+            # days nobody came on are counted too
+            self.assertEqual(days, len([
+                day for day in calendar_days
+                if weekdays is None or day.weekday() in weekdays
+            ]))
+            expected = [0] * (stats.SECONDS_PER_DAY // bucket)
+            for _, day, start, end in rows:
+                if weekdays is not None and day.weekday() not in weekdays:
+                    continue
+                start = utils.seconds_since_midnight(start)
+                end = utils.seconds_since_midnight(end)
+                for i in range(len(expected)):
+                    if start < (i + 1) * bucket and end > i * bucket:
+                        expected[i] += 1
+            self.assertEqual(counts, expected)
+        self.assertEqual(sum(counts), 0)
+        first = datetime.date(2013, 9, 11).toordinal()
+        counts, days = stats.occupancy(presence, 3600, None, first, first)
+        self.assertEqual(days, 1)
+        self.assertEqual(counts[9:17], [2] * 8)
+        # range is limited to days of the store
+        counts, days = stats.occupancy(presence, 3600, None, first, None)
+        self.assertEqual(days, 3)
+        self.assertEqual(stats.occupancy(store.PresenceStore.from_rows([]),
+                                         3600)[1], 0)
+
+    def test_count_days(self):
+        first = datetime.date(2013, 9, 2).toordinal()
+        self.assertEqual(stats.count_days(first, first + 13), 14)
+        self.assertEqual(stats.count_days(first, first - 1), 0)
+        self.assertEqual(stats.count_days(first, first + 9, set([0])), 2)
+        self.assertEqual(stats.count_days(first, first + 9, set([5, 6])), 2)
+        self.assertEqual(stats.count_days(first + 1, first + 7, set([0])), 1)
+
+    def test_accumulator(self):
+        accumulator = stats.WeekdayAccumulator()
+        for row in loader.iter_rows(TEST_DATA_CSV):
+            accumulator.add(*row)
+        streamed = accumulator.to_stats()
+        self.assertEqual(list(streamed.users), list(self.stats.users))
+        for name in streamed.columns:
+            for user_id in (10, 11):
+                self.assertEqual(
+                    streamed.get(user_id, name), self.stats.get(user_id, name),
+                )
+        self.assertNotIn('p50', streamed.columns)
+        self.assertFalse(accumulator.unordered)
+
+    def test_accumulator_repeated_days(self):
+        rows = list(loader.iter_rows(TEST_DATA_CSV))
+        user_id, day, _, end = rows[1]
+        rows.insert(2, (user_id, day, datetime.time(6, 0, 0), end))
+        user_id, day, start, _ = rows[-1]
+        rows.append((user_id, day, start, datetime.time(23, 0, 0)))
+        accumulator = stats.WeekdayAccumulator()
+        for row in rows:
+            accumulator.add(*row)
+        streamed = accumulator.to_stats()
+        expected = stats.WeekdayStats.from_store(
+            store.PresenceStore.from_rows(rows),
+        )
+        for name in streamed.columns:
+            for user_id in (10, 11):
+                self.assertEqual(
+                    streamed.get(user_id, name), expected.get(user_id, name),
+                )
+        self.assertFalse(accumulator.unordered)
+        accumulator = stats.WeekdayAccumulator()
+        for row in reversed(rows):
+            accumulator.add(*row)
+        self.assertTrue(accumulator.unordered)
+
+    def test_streaming_views(self):
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/%s/%d' % (view, user_id)
+            for view in ('mean_time_weekday', 'presence_weekday',
+                         'presence_start_end')
+            for user_id in (10, 11, 12)
+        ] + [
+            '/api/v1/team/mean_time_weekday', '/api/v1/team/presence_weekday',
+            '/api/v1/team/weekday',
+        ]
+        expected = [client.get(url) for url in urls]
+        memory_stats = client.get('/api/v1/stats?metrics=mean,total,min,max')
+        main.app.config['DATA_STORE'] = 'streaming'
+        utils.load_streamed_dataset.invalidate()
+        try:
+            self.assertIsNone(utils.get_store())
+            resp = client.get('/api/v1/presence_weekday/10?from=2013-09-11')
+            self.assertEqual(resp.status_code, 400)
+            for url, response in zip(urls, expected):
+                streamed = client.get(url)
+                self.assertEqual(streamed.status_code, response.status_code)
+                self.assertEqual(streamed.data, response.data)
+            # summaries of rows are the same, percentiles are refused
+            streamed = json.loads(client.get(
+                '/api/v1/stats?metrics=mean,total,min,max').data)
+            self.assertEqual(
+                streamed['users'], json.loads(memory_stats.data)['users'],
+            )
+            for url in ('/api/v1/stats', '/api/v1/stats?metrics=mean,p50'):
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn('streaming mode', resp.data)
+        finally:
+            del main.app.config['DATA_STORE']
+            utils.load_streamed_dataset.invalidate()
+
+
+class PresenceAnalyzerUsersTestCase(unittest.TestCase):
+    """
+    Users directory tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        shutil.copy(TEST_USERS_XML, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_users(self):
+        with open(TEST_USERS_XML) as xml:
+            result = users.parse_users(xml)
+        self.assertItemsEqual(result.keys(), [10, 12, 13])
+        self.assertEqual(
+            result[13],
+            {'name': 'Agata J.',
+             'image_url': 'https://intranet.stxnext.pl/api/images/users/13'},
+        )
+
+    def test_parse_unexpected_structure(self):
+        for content in ('<error>maintenance</error>', '<html>502'):
+            with self.assertRaises(users.UsersXmlError):
+                users.parse_users(StringIO(content))
+        with open(TEST_USERS_XML) as xml:
+            content = xml.read().replace('id="10"', 'id="ten"')
+        with self.assertRaises(users.UsersXmlError):
+            users.parse_users(StringIO(content))
+
+    def test_directory_keeps_users(self):
+        directory = users.UserDirectory(self.path, ttl=0)
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        with open(self.path, 'w') as xml:
+            xml.write('<error>maintenance</error>')
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        self.assertFalse(directory.loaded)
+
+    def test_directory_ttl(self):
+        directory = users.UserDirectory(self.path, ttl=600)
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        self.assertIsNone(directory.get(11))
+        with open(self.path) as xml:
+            content = xml.read()
+        with open(self.path, 'w') as xml:
+            xml.write(content.replace('Adam P.', 'Adam X.'))
+        # within TTL the file is not looked at
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        directory.ttl = 0
+        self.assertEqual(directory.get(10)['name'], 'Adam X.')
+
+    def test_directory_unchanged_source(self):
+        directory = users.UserDirectory(self.path, ttl=0)
+        directory.refresh()
+        loaded = directory.users
+        directory.refresh()
+        self.assertIs(directory.users, loaded)
+        directory.refresh(force=True)
+        self.assertIs(directory.users, loaded)
+
+    def test_unknown_ttl(self):
+        directory = users.UserDirectory(self.path, ttl=0, unknown_ttl=600)
+        self.assertIsNone(directory.get(11))
+        checked = directory.checked
+        # remembered unknown ids do not look at the source
+        self.assertIsNone(directory.get(11))
+        self.assertEqual(directory.checked, checked)
+        with open(self.path) as xml:
+            content = xml.read()
+        with open(self.path, 'w') as xml:
+            xml.write(content.replace('id="12"', 'id="11"'))
+        self.assertIsNone(directory.get(11))
+        # users loaded again forget unknown ids
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        self.assertEqual(directory.get(11)['name'], 'Adrian K.')
+        directory.unknown_ttl = 0
+        self.assertIsNone(directory.get(12))
+        self.assertIn(12, directory.unknown)
+        self.assertIsNone(directory.get(12))
+
+    def test_unknown_after_failed_load(self):
+        os.rename(self.path, self.path + '.old')
+        directory = users.UserDirectory(self.path, ttl=0)
+        self.assertIsNone(directory.get(10))
+        # ids are not remembered as unknown until users are loaded
+        self.assertNotIn(10, directory.unknown)
+        os.rename(self.path + '.old', self.path)
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        self.assertIsNone(directory.get(11))
+        self.assertIn(11, directory.unknown)
+
+    def test_get_directory(self):
+        directory = users.get_directory(self.path)
+        self.assertIs(users.get_directory(self.path), directory)
+        self.assertIsNot(users.get_directory(TEST_USERS_XML), directory)
+
+
+class UsersXmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Keep-alive stand-in of the intranet serving users.xml.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.requests.append(
+                (self.client_address[1], self.headers.get('If-None-Match')),
+            )
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        etag = '"%s"' % hashlib.md5(server.content).hexdigest()
+        if server.status != 200:
+            self.send_response(server.status)
+            body = ''
+        elif self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            body = ''
+        else:
+            self.send_response(200)
+            body = server.content
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class UsersXmlServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server recording requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, content):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), UsersXmlHandler,
+        )
+        self.content = content
+        self.status = 200
+        self.delay = 0
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%d/users.xml' % self.server_port
+
+    def handle_error(self, request, client_address):
+        """
+        Ignores clients which went away before their response was sent.
+        """
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address,
+            )
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    Request handler of werkzeug test server without request log.
+    """
+
+    def log_request(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Instrumentation tests.
+    """
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(
+            histogram.samples(), ([(0.1, 2), (1, 3), ('+Inf', 4)], 3.65, 4),
+        )
+
+    def test_render(self):
+        registry = metrics.Metrics()
+        registry.describe('x_seconds', 'Some latency.')
+        registry.observe('x_seconds', 0.002, stage='a"b')
+        registry.gauge('x_total', 'counter', 'Things.',
+                       lambda: [({'kind': 'y'}, 3), ({}, 0.5)])
+        self.assertEqual(registry.get('x_seconds', stage='a"b').samples()[2],
+                         1)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:2], [
+            '# HELP x_seconds Some latency.', '# TYPE x_seconds histogram',
+        ])
+        self.assertIn('x_seconds_bucket{stage="a\\"b",le="0.001"} 0', lines)
+        self.assertIn('x_seconds_bucket{stage="a\\"b",le="+Inf"} 1', lines)
+        self.assertIn('x_seconds_count{stage="a\\"b"} 1', lines)
+        self.assertEqual(lines[-4:], [
+            '# HELP x_total Things.', '# TYPE x_total counter',
+            'x_total{kind="y"} 3', 'x_total 0.5',
+        ])
+
+    def test_timed(self):
+        @metrics.timed('test_stage')
+        def stage():
+            return 1
+
+        before = metrics.METRICS.get(
+            'presence_stage_duration_seconds', stage='test_stage',
+        )
+        self.assertIsNone(before)
+        self.assertEqual(stage(), 1)
+        self.assertEqual(stage.__name__, 'stage')
+        histogram = metrics.METRICS.get(
+            'presence_stage_duration_seconds', stage='test_stage',
+        )
+        self.assertEqual(histogram.samples()[2], 1)
+        utils.group_by_weekday({})
+        self.assertIsNotNone(metrics.METRICS.get(
+            'presence_stage_duration_seconds', stage='group_by_weekday',
+        ))
+
+
+class PresenceAnalyzerBenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark generator and suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate_csv(self):
+        first = os.path.join(self.tmpdir, 'first.csv')
+        second = os.path.join(self.tmpdir, 'second.csv')
+        rows = generate.generate_csv(first, 20, 30, seed=1)
+        self.assertEqual(generate.generate_csv(second, 20, 30, seed=1), rows)
+        with open(first) as csvfile, open(second) as other:
+            self.assertEqual(csvfile.read(), other.read())
+        data = loader.read_data(first)
+        self.assertEqual(sum(len(days) for days in data.values()), rows)
+        self.assertLessEqual(set(data), set(range(10, 30)))
+        # about 0.8 of 22 working days and few weekend ones
+        self.assertTrue(20 * 15 < rows < 20 * 21)
+
+    def test_generate_users_xml(self):
+        path = os.path.join(self.tmpdir, 'users.xml')
+        ids = generate.generate_users_xml(path, 50, known=0.5)
+        with open(path) as xml:
+            parsed = users.parse_users(xml)
+        self.assertItemsEqual(parsed.keys(), ids)
+        self.assertTrue(10 < len(ids) < 40)
+
+    def test_run_suite(self):
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        config = dict(main.app.config)
+        result = benchmark_suite.run_suite(
+            users=5, days=14, repeat=2, memory=False,
+        )
+        self.assertEqual(dict(main.app.config), config)
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(result['meta']['users'], 5)
+        self.assertIn('load.cold', result['results'])
+        self.assertIn('load.warm', result['results'])
+        for name, _ in benchmark_suite.ENDPOINTS:
+            self.assertIn('endpoint.%s.warm' % name, result['results'])
+        # data of other tests is loaded again
+        self.assertEqual(len(utils.get_store()[11]), 6)
+
+    def test_compare(self):
+        baseline = {'results': {'a': 1.0, 'b': 0.0001, 'c': 1.0}}
+        current = {'results': {'a': 1.2, 'b': 0.0005, 'c': 1.5, 'd': 9}}
+        self.assertEqual(
+            benchmark_suite.compare(current, baseline), [('c', 1.0, 1.5)],
+        )
+        self.assertEqual(
+            benchmark_suite.compare(current, baseline, tolerance=0.1),
+            [('a', 1.0, 1.2), ('c', 1.0, 1.5)],
+        )
+
+    def test_request_paths(self):
+        requests = load.request_paths([10, 11], 200, seed=1)
+        self.assertEqual(requests, load.request_paths([10, 11], 200, seed=1))
+        self.assertEqual(
+            set(name for name, _ in requests),
+            set(name for name, _ in load.LOAD_ENDPOINTS),
+        )
+        self.assertIn(('user', '/api/v1/user/10'), requests)
+        self.assertIn(('user', '/api/v1/user/11'), requests)
+
+    def test_percentile(self):
+        ordered = range(1, 101)
+        self.assertEqual(load.percentile(ordered, 50), 50)
+        self.assertEqual(load.percentile(ordered, 99), 99)
+        self.assertEqual(load.percentile([7], 95), 7)
+        self.assertEqual(load.percentile([], 95), 0.0)
+
+    def use_test_data(self):
+        """
+        Configures test CSV and local users.xml until the test ends.
+        """
+        saved = main.app.config.get('USERS_XML')
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV, 'USERS_XML': TEST_USERS_XML,
+        })
+
+        def restore():
+            if saved is None:
+                main.app.config.pop('USERS_XML', None)
+            else:
+                main.app.config['USERS_XML'] = saved
+            utils.CACHE.clear()
+        self.addCleanup(restore)
+
+    def test_drive(self):
+        self.use_test_data()
+        server = make_server(
+            '127.0.0.1', 0, main.app, threaded=True,
+            request_handler=QuietRequestHandler,
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            requests = [
+                ('user', '/api/v1/user/10'), ('user', '/api/v1/user/1'),
+            ]
+            latencies, errors, seconds = load.drive(
+                'http://127.0.0.1:%d' % server.server_port, requests * 10, 4,
+            )
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(len(latencies['user']), 10)
+        self.assertEqual(errors, {'user': 10})
+        summary = load.summarize(latencies, errors, seconds)
+        self.assertEqual(summary['requests'], 20)
+        self.assertEqual(summary['errors'], 10)
+        self.assertEqual(summary['endpoints']['user']['requests'], 20)
+        self.assertTrue(summary['rps'] > 0)
+        self.assertTrue(0 < summary['p50'] <= summary['p95'] <= summary['p99'])
+
+    @unittest.skipIf(httpserver is None, 'Paste is not installed')
+    def test_run_load(self):
+        self.use_test_data()
+        summary = load.run_load(
+            main.app, requests=50, concurrency=3, workers=2,
+            spawn_if_under=1, max_requests=10,
+        )
+        self.assertEqual(summary['requests'], 50)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(
+            summary['threadpool'],
+            {'workers': 2, 'spawn_if_under': 1, 'max_requests': 10},
+        )
+        self.assertIn('requests/s', load.format_report(summary))
+
+
+class PresenceAnalyzerFetcherTestCase(unittest.TestCase):
+    """
+    Remote users.xml fetching tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        with open(TEST_USERS_XML) as xml:
+            self.content = xml.read()
+        self.server = UsersXmlServer(self.content)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_keep_alive_conditional_get(self):
+        directory = users.UserDirectory(self.server.url, ttl=0)
+        directory.refresh()
+        loaded = directory.users
+        self.assertEqual(loaded[10]['name'], 'Adam P.')
+        directory.refresh()
+        self.assertIs(directory.users, loaded)
+        (port, etag), (reused_port, sent_etag) = self.server.requests
+        self.assertIsNone(etag)
+        self.assertIsNotNone(sent_etag)
+        self.assertEqual(reused_port, port)
+        directory.fetcher.close()
+
+    def test_last_known_good(self):
+        cache_path = os.path.join(self.tmpdir, 'users.xml')
+        directory = users.UserDirectory(
+            self.server.url, ttl=0, timeout=0.2, cache_path=cache_path,
+        )
+        directory.refresh()
+        loaded = directory.users
+        self.server.status = 500
+        directory.refresh()
+        self.assertIs(directory.users, loaded)
+        self.server.status = 200
+        self.server.content = self.content.replace('Adam P.', 'Adam X.')
+        self.server.delay = 0.5
+        directory.refresh()
+        self.assertIs(directory.users, loaded)
+        # fresh process with the intranet down reads the last copy
+        self.server.status = 503
+        self.server.delay = 0
+        restarted = users.UserDirectory(
+            self.server.url, ttl=0, cache_path=cache_path,
+        )
+        restarted.refresh()
+        self.assertEqual(restarted.users, loaded)
+        directory.fetcher.close()
+
+    def test_bad_content_not_cached(self):
+        cache_path = os.path.join(self.tmpdir, 'users.xml')
+        directory = users.UserDirectory(
+            self.server.url, ttl=0, cache_path=cache_path,
+        )
+        directory.refresh()
+        loaded = directory.users
+        validators = directory.validators
+        # proxy error page served with 200
+        self.server.content = '<html>502 Bad Gateway'
+        directory.refresh()
+        self.assertIs(directory.users, loaded)
+        self.assertEqual(directory.validators, validators)
+        with open(cache_path) as xml:
+            self.assertEqual(xml.read(), self.content)
+        directory.fetcher.close()
+
+    def test_bounded_concurrency(self):
+        client = fetcher.HttpFetcher(max_connections=2)
+        self.server.delay = 0.1
+        threads = [
+            threading.Thread(target=client.fetch, args=(self.server.url,))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.max_active, 2)
+        self.assertEqual(len(set(port for port, _ in self.server.requests)), 2)
+        client.close()
+
+    def test_fetch_error(self):
+        client = fetcher.HttpFetcher()
+        self.server.status = 404
+        with self.assertRaises(fetcher.FetchError):
+            client.fetch(self.server.url)
+        client.close()
+        # nothing listens on a port just released
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        with self.assertRaises(fetcher.FetchError):
+            client.fetch('http://127.0.0.1:%d/users.xml' % port)
+
+    def test_background_refresh(self):
+        directory = users.UserDirectory(self.server.url, ttl=0)
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        self.server.content = self.content.replace('Adam P.', 'Adam X.')
+        self.server.delay = 0.2
+        # lookup does not wait for the slow server
+        self.assertEqual(directory.get(10)['name'], 'Adam P.')
+        for _ in range(50):
+            if directory.users[10]['name'] == 'Adam X.':
+                break
+            time.sleep(0.05)
+        self.assertEqual(directory.users[10]['name'], 'Adam X.')
+        directory.fetcher.close()
 
 
 def suite():
@@ -335,6 +2283,18 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCachedTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWatcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSharedTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStatsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerFetcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarkTestCase))
     return base_suite
 
 
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Users directory built from the intranet users.xml.
+"""
+import logging
+import os
+import tempfile
+import time
+from cStringIO import StringIO
+from threading import Lock, Thread
+
+from lxml import etree
+
+from presence_analyzer.fetcher import FetchError, HttpFetcher, \
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_TIMEOUT
+from presence_analyzer.metrics import timed
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_USERS_XML = 'http://sargo.bolt.stxnext.pl/users.xml'
+DEFAULT_USERS_TTL = 600
+DEFAULT_UNKNOWN_TTL = 3600
+
+
+class UsersXmlError(Exception):
+    """
+    Raised when users.xml is malformed or has unexpected structure.
+    """
+
+
+def parse_users(xml):
+    """
+    Parses users.xml file-like object into dict keyed by user id.
+    """
+    try:
+        root = etree.parse(xml).getroot()
+        server = root.find('server')
+        server_url = server.find('protocol').text + '://' \
+            + server.find('host').text
+        users = {}
+        for item in root.find('users'):
+            users[int(item.get('id'))] = {
+                'name': item.find('name').text,
+                'image_url': server_url + item.find('avatar').text,
+            }
+    except (etree.XMLSyntaxError, AttributeError, TypeError,
+            ValueError) as error:
+        raise UsersXmlError(error)
+    return users
+
+
+def is_remote(source):
+    """
+    Checks if source is an HTTP(S) URL rather than a local file.
+    """
+    return source.startswith(('http://', 'https://'))
+
+
+class UserDirectory(object):
+    """
+    In-memory users.xml keyed by user id.
+
+    Source is checked again once ``ttl`` seconds have passed and parsed only
+    when it has changed: by ETag/Last-Modified for URLs and by mtime/size
+    for local files. URLs are fetched with ``HttpFetcher`` of given
+    ``timeout`` and ``max_connections`` and, once users are loaded, in a
+    background thread, so lookups do not wait for the network.
+
+    When loading fails the last loaded users are kept. Every users.xml
+    fetched and parsed is also written to ``cache_path``, if given, and
+    read from there when nothing could be loaded yet.
+
+    Ids missing from successfully loaded users.xml are remembered for
+    ``unknown_ttl`` seconds or until users are loaded again and looked up
+    without checking the source.
+    """
+
+    def __init__(self, source, ttl=DEFAULT_USERS_TTL, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, cache_path=None,
+                 unknown_ttl=DEFAULT_UNKNOWN_TTL):
+        self.source = source
+        self.ttl = ttl
+        self.unknown_ttl = unknown_ttl
+        self.unknown = {}
+        self.fetcher = HttpFetcher(timeout, max_connections)
+        self.cache_path = cache_path
+        self.users = {}
+        self.loaded = False
+        self.validators = {}
+        self.checked = None
+        self.lock = Lock()
+        self.refreshing = False
+
+    def is_fresh(self):
+        """
+        Checks if source was checked less than ``ttl`` seconds ago.
+        """
+        return self.checked is not None \
+            and time.time() - self.checked < self.ttl
+
+    def refresh(self, force=False):
+        """
+        Reloads users when the TTL has passed and the source has changed.
+
+        Errors are logged and tried again after the TTL.
+        """
+        if not force and self.is_fresh():
+            return
+        with self.lock:
+            if not force and self.is_fresh():
+                return
+            try:
+                self.load()
+            except (FetchError, EnvironmentError, UsersXmlError) as error:
+                log.warning('Cannot load users from %s: %s',
+                            self.source, error)
+                self.loaded = False
+                if not self.users:
+                    self.load_cache()
+            else:
+                self.loaded = True
+            self.checked = time.time()
+
+    def refresh_background(self):
+        """
+        Starts refreshing in a thread unless fresh or already refreshing.
+        """
+        if self.is_fresh():
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        thread = Thread(target=self._refresh_background)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_background(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing = False
+
+    @timed('users_xml')
+    def load(self):
+        """
+        Parses users from the source if it has changed.
+
+        Validators of the source are kept and fetched users.xml is cached
+        only once it is parsed.
+        """
+        fetched = self.fetch()
+        if fetched is None:
+            return
+        xml, validators = fetched
+        try:
+            users = parse_users(xml)
+            if is_remote(self.source):
+                self.save_cache(xml.getvalue())
+        finally:
+            xml.close()
+        self.validators = validators
+        self.users = users
+        self.unknown = {}
+        log.debug('Loaded %d users from %s', len(users), self.source)
+
+    def load_cache(self):
+        """
+        Parses users from ``cache_path``, the last users.xml fetched.
+        """
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as xml:
+                self.users = parse_users(xml)
+            self.unknown = {}
+        except (EnvironmentError, UsersXmlError) as error:
+            log.warning('Cannot load users from %s: %s',
+                        self.cache_path, error)
+            return
+        log.info('Loaded %d users from last fetched %s',
+                 len(self.users), self.cache_path)
+
+    def save_cache(self, content):
+        """
+        Writes fetched users.xml to ``cache_path`` atomically.
+        """
+        if self.cache_path is None:
+            return
+        try:
+            handle, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.cache_path) or '.', prefix='.users',
+            )
+            with os.fdopen(handle, 'wb') as output:
+                output.write(content)
+            os.rename(tmp_path, self.cache_path)
+        except EnvironmentError as error:
+            log.warning('Cannot write %s: %s', self.cache_path, error)
+
+    def fetch(self):
+        """
+        Opens the source, returns (file-like object, validators) or None
+        when it has not changed.
+        """
+        if is_remote(self.source):
+            return self._fetch_url()
+        return self._fetch_file()
+
+    def _fetch_file(self):
+        stat = os.stat(self.source)
+        validators = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        if validators == self.validators:
+            return None
+        return open(self.source), validators
+
+    def _fetch_url(self):
+        headers = {}
+        if 'etag' in self.validators:
+            headers['If-None-Match'] = self.validators['etag']
+        if 'last_modified' in self.validators:
+            headers['If-Modified-Since'] = self.validators['last_modified']
+        status, response_headers, body = self.fetcher.fetch(
+            self.source, headers,
+        )
+        if status == 304:
+            return None
+        validators = {}
+        if response_headers.get('etag'):
+            validators['etag'] = response_headers['etag']
+        if response_headers.get('last-modified'):
+            validators['last_modified'] = response_headers['last-modified']
+        return StringIO(body), validators
+
+    def get(self, uid):
+        """
+        Returns user details or None for unknown user id.
+        """
+        if self.unknown.get(uid, 0) > time.time():
+            return None
+        if is_remote(self.source) and self.checked is not None:
+            self.refresh_background()
+        else:
+            self.refresh()
+        details = self.users.get(uid)
+        if details is None and self.loaded:
+            self.unknown[uid] = time.time() + self.unknown_ttl
+        return details
+
+
+_directories = {}  # pylint: disable=invalid-name
+_directories_lock = Lock()  # pylint: disable=invalid-name
+
+
+def get_directory(source, ttl=DEFAULT_USERS_TTL, **kwargs):
+    """
+    Returns shared directory for given source.
+
+    Other ``UserDirectory`` arguments are used only by the directory
+    created by the first call.
+    """
+    with _directories_lock:
+        directory = _directories.get(source)
+        if directory is None:
+            directory = _directories[source] = UserDirectory(
+                source, ttl, **kwargs
+            )
+        directory.ttl = ttl
+        return directory
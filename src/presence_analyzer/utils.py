@@ -3,29 +3,66 @@
 Helper functions used in views.
 """
 
-import csv
+import zlib
 from hashlib import md5
-import pickle
-from threading import Lock
-import urllib
+from threading import Lock, Thread
 
-
-from datetime import datetime, timedelta
 from json import dumps
 from functools import wraps
 
-from flask import Response
-
-from lxml import etree
+from flask import Response, abort, request
 
+from presence_analyzer.cache import Cache, KeyLocks, MISSING, make_key
+from presence_analyzer.dataset import dataset_from_user_columns, \
+    merge_dataset, stream_dataset
+from presence_analyzer.fetcher import DEFAULT_TIMEOUT, \
+    DEFAULT_MAX_CONNECTIONS
+from presence_analyzer.loader import get_ingester, iter_rows, parse_date, \
+    read_data
 from presence_analyzer.main import app
+from presence_analyzer.metrics import METRICS, timed, timer
+from presence_analyzer.snapshot import DatasetSnapshot, is_columnar, \
+    read_dataset
+from presence_analyzer.stats import ROLLUP_COLUMNS, TeamStats
+from presence_analyzer.users import get_directory, DEFAULT_UNKNOWN_TTL, \
+    DEFAULT_USERS_TTL, DEFAULT_USERS_XML
+from presence_analyzer.watcher import get_watcher
 
 import logging
 
 log = logging.getLogger(__name__)
 # pylint: disable=invalid-name, missing-docstring
 
-CACHE = {}
+CACHE = Cache()
+ANONYMOUS_NAME = 'Anonymous user'
+
+
+def cache_ratio():
+    """
+    Returns share of ``CACHE`` lookups which were hits.
+    """
+    stats = CACHE.stats()
+    lookups = stats['hits'] + stats['misses']
+    return [({}, float(stats['hits']) / lookups if lookups else 0)]
+
+
+METRICS.gauge(
+    'presence_cache_requests_total', 'counter', 'Cache lookups by result.',
+    lambda: [({'result': 'hit'}, CACHE.hits),
+             ({'result': 'miss'}, CACHE.misses)],
+)
+METRICS.gauge(
+    'presence_cache_hit_ratio', 'gauge', 'Share of cache lookups hit.',
+    cache_ratio,
+)
+METRICS.gauge(
+    'presence_cache_evictions_total', 'counter', 'Cache entries evicted.',
+    lambda: [({}, CACHE.evictions)],
+)
+METRICS.gauge(
+    'presence_cache_entries', 'gauge', 'Cache entries kept.',
+    lambda: [({}, len(CACHE))],
+)
 
 
 def jsonify(function):
@@ -38,33 +75,155 @@ def jsonify(function):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        result = function(*args, **kwargs)
+        with timer('json'):
+            body = dumps(result)
+        return Response(body, mimetype='application/json')
+
+    return inner
+
+
+def jsonify_cached(function):
+    """
+    Like ``jsonify``, but keeps serialized result until the dataset changes.
+
+    Responses carry a strong ETag and requests with matching
+    ``If-None-Match`` are answered with 304. Bodies are kept in ``CACHE``
+    where those of older datasets are evicted as least recently used.
+    Dataset version is sent in ``X-Data-Version`` header.
+    """
+
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        key = (
+            'response', get_dataset().version,
+            make_key(function, args, kwargs),
+            tuple(sorted(request.args.items(multi=True))),
         )
+        entry = CACHE.get(key)
+        if entry is None:
+            result = function(*args, **kwargs)
+            with timer('json'):
+                body = dumps(result)
+            entry = (body, md5(body).hexdigest())
+            CACHE.set(key, entry)
+        body, etag = entry
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['X-Data-Version'] = str(key[1])
+        return response.make_conditional(request)
 
     return inner
 
 
-def cached(exp_time):
+def gzip_chunks(chunks, level=6):
+    """
+    Compresses chunks of a body into gzip format as they are produced.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 
-    cache_lock = Lock()
+def streamed_json(chunks):
+    """
+    Creates a response streaming chunks of JSON body.
+
+    The body is gzip compressed when the client accepts that encoding.
+    """
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='application/json', headers=headers)
+
+
+def list_arg(name):
+    """
+    Returns values of repeated or comma separated request argument.
+    """
+    return [
+        value.strip()
+        for arg in request.args.getlist(name)
+        for value in arg.split(',')
+        if value.strip()
+    ]
+
+
+def cached(exp_time, cache=CACHE, stale=False):
+    """
+    Caches function results for ``exp_time`` seconds.
+
+    Results are kept in shared ``CACHE`` unless other ``Cache`` is given.
+    Concurrent calls with the same arguments wait for one computation,
+    calls with other arguments are not blocked. With ``stale`` an expired
+    result is returned right away while one background thread computes
+    the new one.
+
+    Wrapped function gets ``invalidate(*args, **kwargs)`` which drops
+    cached result of that call.
+    """
+
+    key_locks = KeyLocks()
+    refreshing = set()
+    refreshing_lock = Lock()
 
     def inner(function):
+        def compute(key, args, kwargs):
+            result = function(*args, **kwargs)
+            cache.set(key, result, exp_time)
+            return result
+
+        def refresh(key, args, kwargs):
+            try:
+                with key_locks(key):
+                    compute(key, args, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', function.__name__)
+            finally:
+                with refreshing_lock:
+                    refreshing.discard(key)
+
         @wraps(function)
         def inner(*args, **kwargs):
-            with cache_lock:
-                key = md5(repr(function)+repr(args)+repr(kwargs))
-                age = datetime.now() - timedelta(seconds=exp_time)
-                if CACHE.get(key) is None or CACHE[key]['timestamp'] <= age:
-                    CACHE[key] = {'timestamp': datetime.now(),
-                                  'data': function(*args, **kwargs)}
-                return CACHE[key]['data']
+            key = make_key(function, args, kwargs)
+            result, expired = cache.get_entry(key)
+            if result is not MISSING and not expired:
+                return result
+            if result is not MISSING and stale:
+                with refreshing_lock:
+                    start = key not in refreshing
+                    refreshing.add(key)
+                if start:
+                    thread = Thread(target=refresh, args=(key, args, kwargs))
+                    thread.daemon = True
+                    thread.start()
+                return result
+            with key_locks(key):
+                result, expired = cache.get_entry(key)
+                if result is MISSING or expired:
+                    result = compute(key, args, kwargs)
+                return result
+
+        def invalidate(*args, **kwargs):
+            """
+            Drops cached result of given call.
+            """
+            cache.invalidate(make_key(function, args, kwargs))
+
+        inner.invalidate = invalidate
         return inner
     return inner
 
 
-@cached(600)
+@cached(600, stale=True)
+@timed('get_data')
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -82,28 +241,173 @@ def get_data():
             },
         }
     }
+
+    Unless ``DATA_CSV_INCREMENTAL`` is disabled, the file is read once and
+    later calls parse only rows appended since then.
+
+    With ``DATA_STORE = 'columnar'`` or a columnar presence file the
+    ``get_store()`` mapping with the same content is returned instead.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    if app.config.get('DATA_STORE') == 'columnar' \
+            or is_columnar(app.config['DATA_CSV']):
+        return get_store()
+    if not app.config.get('DATA_CSV_INCREMENTAL', True):
+        return read_data(app.config['DATA_CSV'])
+    return get_ingester(app.config['DATA_CSV']).update()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def get_dataset():
+    """
+    Returns current ``Dataset``.
+
+    It is the last one published by the background watcher of ``DATA_CSV``
+    when it is running and has data, otherwise it is loaded on demand.
+    With ``DATA_STORE = 'streaming'`` it has only weekday summaries, see
+    ``load_streamed_dataset()``.
+    """
+    if app.config.get('DATA_STORE') == 'streaming':
+        return load_streamed_dataset()
+    watcher = get_watcher(app.config['DATA_CSV'])
+    if watcher is not None and watcher.dataset is not None:
+        return watcher.dataset
+    return load_dataset()
+
+
+@cached(600, stale=True)
+@timed('load_dataset')
+def load_dataset():
+    """
+    Extracts presence data from CSV file into ``Dataset`` with columnar
+    store and weekday summaries materialized after every load or update.
+    Columnar presence file is mapped as it is.
+    """
+    if is_columnar(app.config['DATA_CSV']):
+        return read_dataset(app.config['DATA_CSV'])
+    if not app.config.get('DATA_CSV_INCREMENTAL', True):
+        return read_data(app.config['DATA_CSV'], merge_dataset)
+    return get_ingester(
+        app.config['DATA_CSV'], merge_dataset, snapshot=get_snapshot(),
+        workers=app.config.get('LOADER_WORKERS', 1),
+        from_columns=dataset_from_user_columns,
+    ).update()
+
+
+@cached(600, stale=True)
+@timed('load_dataset')
+def load_streamed_dataset():
+    """
+    Folds rows of CSV file into weekday summaries while reading it.
+
+    Memory used grows with the number of users, not rows, but the file is
+    read again from the start on every reload. Columnar presence file has
+    summaries already, it is mapped instead.
+    """
+    if is_columnar(app.config['DATA_CSV']):
+        return read_dataset(app.config['DATA_CSV'])
+    return stream_dataset(iter_rows(app.config['DATA_CSV']))
+
+
+def get_snapshot():
+    """
+    Returns ``DatasetSnapshot`` stored next to ``DATA_CSV`` when
+    ``DATA_SNAPSHOT`` is enabled.
+    """
+    if not app.config.get('DATA_SNAPSHOT'):
+        return None
+    return DatasetSnapshot(app.config['DATA_CSV'] + '.snapshot')
 
-    return data
 
+def get_store():
+    """
+    Returns columnar ``PresenceStore`` of current dataset, None in
+    streaming mode.
+    """
+    return get_dataset().store
+
+
+def get_weekday_stats():
+    """
+    Returns ``WeekdayStats`` of all users of current dataset.
+    """
+    return get_dataset().weekday_stats
 
+
+def date_window(dataset):
+    """
+    Returns (first, last) day ordinals of ``from`` and ``to`` request
+    arguments, None when neither is given.
+
+    Both are ``YYYY-MM-DD`` dates and inclusive, either can be left out.
+    Invalid dates, and any dates for datasets without store (streaming
+    mode), are answered with 400.
+    """
+    window = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        if not value:
+            window.append(None)
+            continue
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            log.debug('Invalid %s date %r', name, value)
+            abort(400)
+        window.append(day.toordinal())
+    if window == [None, None]:
+        return None
+    if dataset.store is None:
+        log.debug('Date range needs rows, not kept in streaming mode')
+        abort(400)
+    return tuple(window)
+
+
+def user_stats(dataset, user_id, window=None, names=None):
+    """
+    Returns weekday statistics of user by name, None for unknown users.
+
+    Only statistics of given ``names`` are returned, all by default. With
+    ``window`` of (first, last) day ordinals only those days are counted,
+    it needs a dataset with store.
+    """
+    stats = dataset.weekday_stats
+    if user_id not in stats:
+        return None
+    if names is None:
+        names = stats.columns
+    if window is None:
+        return dict((name, stats.get(user_id, name)) for name in names)
+    return dataset.weekday_index.window(user_id, window[0], window[1], names)
+
+
+def get_user_stats(user_id, names=None):
+    """
+    Returns given weekday statistics of user within request date window.
+    """
+    dataset = get_dataset()
+    return user_stats(dataset, user_id, date_window(dataset), names)
+
+
+def get_team_weekdays():
+    """
+    Returns weekday rollup of all users within request date window.
+
+    Without window it is the one materialized with the dataset.
+    """
+    dataset = get_dataset()
+    window = date_window(dataset)
+    if window is None:
+        return dataset.team_stats.weekdays
+    stats = dataset.weekday_stats
+    return TeamStats.weekday_rollup(
+        (user_stats(dataset, user_id, window, ROLLUP_COLUMNS)
+         for user_id in stats.users),
+        stats.percentiles,
+    )
+
+
+@timed('group_by_weekday')
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
@@ -137,65 +441,79 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def start_end_entry(seconds):
+    """
+    Formats seconds since midnight as ``[1, 1, 1, hour, minute, second]``.
+
+    Missing values (None) are shown as noon.
+    """
+    if seconds is None:
+        return [1, 1, 1, 12, 0, 0]
+    seconds = int(round(seconds))
+    return [1, 1, 1, seconds // 3600, seconds // 60 % 60, seconds % 60]
+
+
+@timed('group_by_weekday_start_end')
 def group_by_weekday_start_end(items):
     """
-    Groups presence entries by weekday.
+    Groups presence entries by weekday, returns mean start and end times.
     """
-    result = {0: [], 1: [], 2: [], 3: [], 4: [], 5: [], 6: []}
+    counts = [0] * 7
+    starts = [0] * 7
+    ends = [0] * 7
     for date in items:
-        start = str(items[date]['start']).split(':')
-        end = str(items[date]['end']).split(':')
-        start_2 = [1, 1, 1, int(start[0]), int(start[1]), int(start[2])]
-        end_2 = [1, 1, 1, int(end[0]), int(end[1]), int(end[2])]
-        if not result[date.weekday()]:
-            result[date.weekday()] = [start_2, end_2]
+        weekday = date.weekday()
+        counts[weekday] += 1
+        starts[weekday] += seconds_since_midnight(items[date]['start'])
+        ends[weekday] += seconds_since_midnight(items[date]['end'])
+    result = {}
+    for weekday, count in enumerate(counts):
+        if count:
+            result[weekday] = [
+                start_end_entry(float(starts[weekday]) / count),
+                start_end_entry(float(ends[weekday]) / count),
+            ]
         else:
-            for i in range(5):
-                start_2[i] = (start_2[i] + (result[date.weekday()])[0][i]) / 2
-                end_2[i] = (end_2[i] + (result[date.weekday()])[1][i]) / 2
-            result[date.weekday()] = [start_2, end_2]
-    for day in result:
-        if not result[day]:
-            result[day] = [[1, 1, 1, 12, 0, 0], [1, 1, 1, 12, 0, 0]]
+            result[weekday] = [start_end_entry(None), start_end_entry(None)]
     return result
 
 
+@timed('user')
 def user(uid, data=False, name=True, image_url=True):
-    users = {}
-    if not data:
-        xml = urllib.urlopen('http://sargo.bolt.stxnext.pl/users.xml')
-    else:
-        try:
-            xml = open(data)
-        except KeyError:
-            xml = urllib.urlopen(data)
-
-    tree = etree.parse(xml)
-    root = tree.getroot()
-    server = root.find('server')
-    server_url = server.find('protocol').text + "://" \
-        + server.find('host').text
-    for user in root.find('users'):
-        users[int(user.get('id'))] = \
-            {
-                'name': user.find('name').text,
-                'image_url': server_url + user.find('avatar').text,
-                }
-    try:
-        if name and image_url:
-            return users[uid]
-        elif not name and image_url:
-            return users[uid]['image_url']
-        else:
-            return users[uid]['name']
-    except KeyError:
+    """
+    Returns user details from users.xml.
+
+    ``data`` overrides the source configured in ``USERS_XML``, it can be
+    a local path or an URL.
+    """
+    source = data or app.config.get('USERS_XML', DEFAULT_USERS_XML)
+    directory = get_directory(
+        source, app.config.get('USERS_XML_TTL', DEFAULT_USERS_TTL),
+        timeout=app.config.get('USERS_XML_TIMEOUT', DEFAULT_TIMEOUT),
+        max_connections=app.config.get(
+            'USERS_XML_CONNECTIONS', DEFAULT_MAX_CONNECTIONS,
+        ),
+        cache_path=app.config.get('USERS_XML_CACHE'),
+        unknown_ttl=app.config.get('USERS_UNKNOWN_TTL', DEFAULT_UNKNOWN_TTL),
+    )
+    details = directory.get(uid)
+    if details is not None:
         if name and image_url:
-            return {'name': "Anonymous user",
-                    'image_url': 'http://www.designofsignage.com/application/'
-                                 'symbol/building/image/600x600/no-photo.jpg'}
+            return details
         elif not name and image_url:
-            return {'image_url': 'http://www.designofsignage.com/'
-                                 'application/symbol/building/'
-                                 'image/600x600/no-photo.jpg'}
+            return details['image_url']
         else:
-            return "Anonymous user"
+            return details['name']
+    if name and image_url:
+        return {'name': ANONYMOUS_NAME, 'image_url': default_avatar()}
+    elif not name and image_url:
+        return {'image_url': default_avatar()}
+    else:
+        return ANONYMOUS_NAME
+
+
+def default_avatar():
+    """
+    Returns URL of the avatar of users missing from users.xml.
+    """
+    return app.static_url_path + '/img/no-photo.png'
@@ -5,17 +5,69 @@ Defines views.
 # pylint: disable=invalid-name
 
 import calendar
+import cProfile
+import os
+import tempfile
+import time
+from datetime import date
+from json import dumps
 
-from flask import redirect, abort, render_template, url_for
+from flask import Response, g, redirect, abort, render_template, request, \
+    url_for
 
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, mean, group_by_weekday, \
-    group_by_weekday_start_end, user
+from presence_analyzer.metrics import METRICS, CONTENT_TYPE
+from presence_analyzer.utils import jsonify, jsonify_cached, date_window, \
+    get_dataset, get_team_weekdays, get_user_stats, get_weekday_stats, \
+    list_arg, start_end_entry, streamed_json, user, user_stats
+from presence_analyzer.stats import SECONDS_PER_DAY, occupancy
 
 import logging
 log = logging.getLogger(__name__)
 
 
+@app.before_request
+def start_request():
+    """
+    Notes request start, starts profiler when asked for.
+
+    Requests with ``X-Profile`` header are profiled when ``PROFILING`` is
+    enabled.
+    """
+    g.request_start = time.time()
+    if app.config.get('PROFILING') and request.headers.get('X-Profile'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Records request latency, saves profile of profiled requests.
+
+    Profile is written in ``pstats`` format to ``PROFILE_DIR`` (temporary
+    directory by default), its path is sent in ``X-Profile`` header.
+    Streamed response bodies are produced after this point and are not
+    included.
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        handle, path = tempfile.mkstemp(
+            suffix='.prof', prefix='%s-' % request.endpoint,
+            dir=app.config.get('PROFILE_DIR'),
+        )
+        os.close(handle)
+        profiler.dump_stats(path)
+        response.headers['X-Profile'] = path
+    METRICS.observe(
+        'presence_request_duration_seconds',
+        time.time() - g.request_start, endpoint=request.endpoint or 'none',
+        method=request.method, status=response.status_code,
+    )
+    return response
+
+
 @app.route('/')
 def mainpage():
     """
@@ -48,16 +100,23 @@ def presence_start_end_way():
     return render_template('presence_start_end.html')
 
 
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns latency histograms and cache counters for Prometheus.
+    """
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
     return [
         {'user_id': i, 'name': user(i, name=True, image_url=False)}
-        for i in data.keys()
+        for i in get_weekday_stats().users
     ]
 
 
@@ -67,8 +126,7 @@ def user_view(user_id):
     """
     Users details.
     """
-    data = get_data()
-    if user_id not in data:
+    if user_id not in get_weekday_stats():
         log.debug('User %s not found!', user_id)
         abort(404)
     return user(user_id)
@@ -76,20 +134,19 @@ def user_view(user_id):
 
 @app.route('/api/v1/mean_time_weekday/', methods=['GET'])
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify_cached
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday(bar graph)
     """
-    data = get_data()
-    if user_id not in data:
+    stats = get_user_stats(user_id, ('mean',))
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
     result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(stats['mean'])
     ]
 
     return result
@@ -97,20 +154,19 @@ def mean_time_weekday_view(user_id):
 
 @app.route('/api/v1/presence_weekday/', methods=['GET'])
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify_cached
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday(circle graph)
     """
-    data = get_data()
-    if user_id not in data:
+    stats = get_user_stats(user_id, ('total',))
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
     result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(stats['total'])
     ]
     result.insert(0, ('Weekday', 'Presence (s)'))
     return result
@@ -118,17 +174,163 @@ def presence_weekday_view(user_id):
 
 @app.route('/api/v1/presence_start_end/', methods=['GET'])
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify_cached
 def presence_start_end_view(user_id):
     """
-    Returns mean presence time of given user grouped by weekday.
+    Returns mean start and end time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    stats = get_user_stats(user_id, ('count', 'start_mean', 'end_mean'))
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
-    weekdays = group_by_weekday_start_end(data[user_id])
-    result = []
-    for i in weekdays:
-        result.append([calendar.day_abbr[i], weekdays[i][0], weekdays[i][1]])
+    counts = stats['count']
+    starts = stats['start_mean']
+    ends = stats['end_mean']
+    return [
+        [
+            calendar.day_abbr[weekday],
+            start_end_entry(starts[weekday] if count else None),
+            start_end_entry(ends[weekday] if count else None),
+        ]
+        for weekday, count in enumerate(counts)
+    ]
+
+
+@app.route('/api/v1/stats', methods=['GET'])
+def bulk_stats_view():
+    """
+    Returns weekday statistics of many users in one streamed response.
+
+    ``users`` lists user ids or is ``all`` (default), ``metrics`` names
+    statistics, all by default. Ids without data are listed in
+    ``missing``. ``from`` and ``to`` dates limit days counted.
+
+    Summaries of streaming mode have no percentiles, so there metrics
+    have to be given and cannot be percentiles.
+    """
+    dataset = get_dataset()
+    stats = dataset.weekday_stats
+    window = date_window(dataset)
+    metrics = list_arg('metrics')
+    if dataset.store is None and (not metrics or any(
+            metric.startswith('p') and metric[1:].isdigit()
+            for metric in metrics)):
+        log.debug('Percentiles are not kept in streaming mode')
+        abort(400, 'Percentiles are not kept in streaming mode, '
+                   'give metrics without them.')
+    metrics = metrics or sorted(stats.columns)
+    if any(metric not in stats.columns for metric in metrics):
+        log.debug('Unknown metrics %s', metrics)
+        abort(400)
+    user_ids = list_arg('users')
+    if not user_ids or user_ids == ['all']:
+        user_ids = list(stats.users)
+    else:
+        try:
+            user_ids = [int(user_id) for user_id in user_ids]
+        except ValueError:
+            abort(400)
+    missing = [user_id for user_id in user_ids if user_id not in stats]
+
+    def chunks():
+        """
+        Yields JSON body, one user at a time.
+        """
+        yield '{"version": %d, "users": {' % dataset.version
+        separator = ''
+        for user_id in user_ids:
+            values = user_stats(dataset, user_id, window, metrics)
+            if values is not None:
+                yield '%s"%d": %s' % (separator, user_id, dumps(values))
+                separator = ', '
+        yield '}, "missing": %s}' % dumps(missing)
+
+    return streamed_json(chunks())
+
+
+@app.route('/api/v1/team/mean_time_weekday', methods=['GET'])
+@jsonify_cached
+def team_mean_time_weekday_view():
+    """
+    Returns mean presence time of all users grouped by weekday.
+    """
+    return [
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(get_team_weekdays()['mean'])
+    ]
+
+
+@app.route('/api/v1/team/presence_weekday', methods=['GET'])
+@jsonify_cached
+def team_presence_weekday_view():
+    """
+    Returns total presence time of all users grouped by weekday.
+    """
+    result = [
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(get_team_weekdays()['total'])
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
+
+
+@app.route('/api/v1/team/weekday', methods=['GET'])
+@jsonify_cached
+def team_weekday_view():
+    """
+    Returns all weekday rollups of all users, see ``TeamStats``.
+    """
+    return get_team_weekdays()
+
+
+@app.route('/api/v1/team/headcount', methods=['GET'])
+@jsonify_cached
+def team_headcount_view():
+    """
+    Returns number of users present and their presence time for every day.
+    """
+    dataset = get_dataset()
+    window = date_window(dataset) or (None, None)
+    if dataset.store is None:
+        log.debug('Headcount needs rows, not kept in streaming mode')
+        abort(400)
+    return [
+        (date.fromordinal(day).isoformat(), headcount, total)
+        for day, headcount, total in dataset.team_stats.days(*window)
+    ]
+
+
+@app.route('/api/v1/team/occupancy', methods=['GET'])
+@jsonify_cached
+def team_occupancy_view():
+    """
+    Returns number of users present in every part of the day.
+
+    ``bucket`` is the part length in seconds (900 by default), it has to
+    divide the day. ``weekday`` lists weekdays counted, Monday is 0, and
+    ``from`` and ``to`` limit dates. Every part is given as start time,
+    presence summed over all counted days and mean presence per calendar
+    day of those weekdays between the first and last day of data, days
+    nobody came on included.
+    """
+    dataset = get_dataset()
+    window = date_window(dataset) or (None, None)
+    if dataset.store is None:
+        log.debug('Occupancy needs rows, not kept in streaming mode')
+        abort(400)
+    try:
+        bucket = int(request.args.get('bucket', 900))
+        weekdays = set(int(day) for day in list_arg('weekday')) or None
+    except ValueError:
+        abort(400)
+    if not 0 < bucket <= SECONDS_PER_DAY or SECONDS_PER_DAY % bucket or \
+            weekdays and not weekdays <= set(range(7)):
+        abort(400)
+    counts, days = occupancy(dataset.store, bucket, weekdays, *window)
+    return [
+        (
+            '%02d:%02d' % divmod(i * bucket // 60, 60), count,
+            float(count) / days if days else 0,
+        )
+        for i, count in enumerate(counts)
+    ]
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Background reloading of presence data.
+"""
+import logging
+import os
+from threading import Event, Lock, Thread
+
+from presence_analyzer.dataset import dataset_from_user_columns, \
+    merge_dataset
+from presence_analyzer.loader import CsvIngester
+from presence_analyzer.snapshot import ColumnarIngester, is_columnar
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_INTERVAL = 5
+
+
+class DataWatcher(object):
+    """
+    Thread polling presence CSV and publishing new datasets.
+
+    The file is checked every ``interval`` seconds. Appended rows are
+    parsed and summaries materialized in the watcher thread, then the new
+    dataset replaces ``dataset`` with a single assignment, so requests
+    always read one consistent snapshot. Columnar presence files are
+    mapped again when replaced.
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, snapshot=None,
+                 workers=1):
+        self.path = path
+        self.interval = interval
+        if is_columnar(path):
+            self.ingester = ColumnarIngester(path)
+        else:
+            self.ingester = CsvIngester(
+                path, merge_dataset, snapshot, workers,
+                dataset_from_user_columns,
+            )
+        self.dataset = None
+        self.stopped = Event()
+        self.thread = None
+        self.pid = os.getpid()
+
+    def reload(self):
+        """
+        Reads changes of the file, returns True when dataset was replaced.
+        """
+        dataset = self.ingester.update()
+        if dataset is self.dataset:
+            return False
+        self.dataset = dataset
+        log.info('Presence data version %d published', dataset.version)
+        return True
+
+    def run(self):
+        """
+        Reloads data until stopped, errors are logged and retried.
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.reload()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Reloading %s failed', self.path)
+
+    def start(self):
+        """
+        Loads data and starts polling thread.
+        """
+        self.reload()
+        self.thread = Thread(target=self.run, name='presence-data-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops polling thread.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def abandon(self):
+        """
+        Gives up watcher inherited from the parent of a forked process.
+
+        Its polling thread did not survive the fork, resources shared with
+        the parent are released here without touching the parent's ones.
+        """
+        self.stopped.set()
+
+
+_watchers = {}  # pylint: disable=invalid-name
+_watchers_arguments = {}  # pylint: disable=invalid-name
+_watchers_lock = Lock()  # pylint: disable=invalid-name
+
+
+def start_watcher(path, interval=DEFAULT_INTERVAL, snapshot=None,
+                  factory=DataWatcher, **kwargs):
+    """
+    Starts watcher of given CSV path unless it is already running.
+
+    Watcher is created by ``factory(path, interval=interval,
+    snapshot=snapshot, **kwargs)``. Watcher started before this process
+    was forked is replaced by a new one.
+    """
+    with _watchers_lock:
+        watcher = _watchers.get(path)
+        if watcher is None or watcher.pid != os.getpid():
+            if watcher is not None:
+                log.info('Restarting watcher of %s in process %d',
+                         path, os.getpid())
+                watcher.abandon()
+            watcher = factory(
+                path, interval=interval, snapshot=snapshot, **kwargs
+            )
+            watcher.start()
+            _watchers[path] = watcher
+            _watchers_arguments[path] = (interval, snapshot, factory, kwargs)
+        return watcher
+
+
+def get_watcher(path):
+    """
+    Returns running watcher of given path or None.
+
+    Servers forking workers after the app is loaded leave them a copy of
+    the watcher without polling thread, it is started again with the same
+    arguments in the worker on first use.
+    """
+    watcher = _watchers.get(path)
+    if watcher is not None and watcher.pid != os.getpid():
+        interval, snapshot, factory, kwargs = _watchers_arguments[path]
+        watcher = start_watcher(path, interval, snapshot, factory, **kwargs)
+    return watcher
+
+
+def stop_watcher(path):
+    """
+    Stops watcher of given path.
+    """
+    with _watchers_lock:
+        watcher = _watchers.pop(path, None)
+        _watchers_arguments.pop(path, None)
+    if watcher is not None:
+        watcher.stop()